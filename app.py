@@ -1,28 +1,294 @@
 from flask import Flask, render_template, request, redirect, url_for, flash
-from flask import session, jsonify, send_file
+from flask import session, jsonify, send_file, g
+from flask import Blueprint, current_app
+from flask import Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from flask_bcrypt import Bcrypt
+from werkzeug.local import LocalProxy
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-from functools import wraps
-from faker import Faker
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import joinedload, selectinload, contains_eager
+from flask import has_request_context
+from flask import before_render_template, template_rendered
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from jinja2 import TemplateNotFound
+from jinja2 import FileSystemBytecodeCache, TemplateNotFound
+from markupsafe import Markup
+from report_index import ReportIndex, remove_index_files
+from images import ImagePipeline, store_upload, original_name, srcset
+from images import NotAnImage, is_content_addressed, upload_mimetype
+from fragment_cache import make_fragment_cache
+from metrics import Registry, COUNT_BUCKETS
+from request_profiler import ProfileStore
+from storage import LocalStorage, S3Storage
+from compression import (ENCODING_SUFFIXES, CompressingWriter,
+                         available_encodings, choose_encoding,
+                         compress_response, fresh_precompressed_path,
+                         is_compressible, precompress_directory,
+                         precompressed_path)
+from contextlib import ExitStack
+import migrations
+import click
+import copy
+import cProfile
 import os
+import posixpath
 import random
+import socket
 import csv
-
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your_secret_key' 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///thrift_and_thrive.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+import hashlib
+import hmac
+import io
+import json
+import mimetypes
+import tempfile
+import threading
+import time
+
+# Default settings of every app made by create_app()
+DEFAULT_CONFIG = {}
+DEFAULT_CONFIG['SECRET_KEY'] = 'your_secret_key' 
+# DATABASE_URL points the app at another database, e.g. a scratch copy for
+# benchmarks
+DEFAULT_CONFIG['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'DATABASE_URL', 'sqlite:///thrift_and_thrive.db')
+DEFAULT_CONFIG['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection pools for the default (read-write) engine and the read engine
+# below. Only applied to databases with a pool of connections (files and
+# servers, not in-memory SQLite); see pool_options
+DEFAULT_CONFIG['DB_POOL_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_timeout': 10,
+    'pool_pre_ping': True,
+}
+DEFAULT_CONFIG['READ_DB_POOL_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 10,
+    'pool_timeout': 10,
+    'pool_pre_ping': True,
+}
+# Read-only routes (see @read_only) run their queries on a separate engine,
+# by default over the same database, so they never queue behind writers
+DEFAULT_CONFIG['SQLALCHEMY_BINDS'] = {'read': {}}
+DEFAULT_CONFIG['USE_READ_ENGINE'] = True
+# Set on every new SQLite connection. WAL lets readers and a writer work at
+# the same time, and busy_timeout makes writers wait for the lock instead
+# of failing with "database is locked". Set to {} to keep SQLite defaults.
+DEFAULT_CONFIG['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,  # Milliseconds
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # Negative means KiB, so about 64 MB
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+# Catalog pagination: default page size and the hard upper limit a client
+# may request through ?per_page=
+DEFAULT_CONFIG['SHOP_PAGE_SIZE'] = 24
+DEFAULT_CONFIG['SHOP_MAX_PAGE_SIZE'] = 100
+# Seconds a process may answer conditional /api/products requests (304 Not
+# Modified) from the catalog version it last read, without a query. Catalog
+# changes made through other processes show up at most this late; 0 reads
+# the version on every request.
+DEFAULT_CONFIG['API_CATALOG_VERSION_MAX_AGE'] = 5
+# Keep the cart badge count in the session between requests. The cached
+# count is dropped whenever this user changes their cart, but bulk admin
+# deletes cannot reach other users' sessions, so it is off by default.
+DEFAULT_CONFIG['CACHE_CART_COUNT_IN_SESSION'] = False
+# Views decorated with @query_budget only log a warning when they run more
+# SQL statements than allowed. With this set, or under TESTING, they raise
+# instead; benchmarks.py sets it so a regression fails the run.
+DEFAULT_CONFIG['ENFORCE_QUERY_BUDGETS'] = False
+# Number of recent purchases listed on the admin dashboard
+DEFAULT_CONFIG['ADMIN_RECENT_PURCHASES'] = 50
+# Days of sales, and number of best sellers, summarised on the dashboard
+DEFAULT_CONFIG['ADMIN_SALES_DAYS'] = 30
+DEFAULT_CONFIG['ADMIN_TOP_PRODUCTS'] = 5
+# Rows fetched from the database (and flushed to the client) per batch when
+# generating purchase reports
+DEFAULT_CONFIG['REPORT_BATCH_SIZE'] = 1000
+# Background jobs (reports and bulk admin operations). JOBS_RUN_INLINE runs
+# them inside the request instead, for tests and serverless deploys where
+# threads do not outlive the response.
+DEFAULT_CONFIG['JOB_WORKERS'] = 2
+DEFAULT_CONFIG['JOBS_RUN_INLINE'] = False
+# A running job writes its progress to its row at most this often (seconds)
+DEFAULT_CONFIG['JOB_PROGRESS_INTERVAL'] = 1.0
+# Each process renews a heartbeat on the jobs it holds every
+# JOB_HEARTBEAT_INTERVAL seconds. Active jobs without one for
+# JOB_HEARTBEAT_TIMEOUT seconds lost their process and are failed.
+DEFAULT_CONFIG['JOB_HEARTBEAT_INTERVAL'] = 10
+DEFAULT_CONFIG['JOB_HEARTBEAT_TIMEOUT'] = 60
+# The "delete all" jobs remove this many rows per transaction and pause
+# between transactions, so other writers (checkout above all) never wait
+# long for the database's write lock
+DEFAULT_CONFIG['PURGE_BATCH_SIZE'] = 500
+DEFAULT_CONFIG['PURGE_BATCH_PAUSE'] = 0.01  # Seconds
+# Most add/update/remove operations accepted in one /cart/batch request
+DEFAULT_CONFIG['CART_BATCH_MAX_OPERATIONS'] = 100
+# bcrypt cost factor for new hashes. Existing hashes with a different cost
+# are rehashed transparently the next time their owner logs in.
+DEFAULT_CONFIG['BCRYPT_LOG_ROUNDS'] = 12
+# Hashing runs on its own small thread pool so signup spikes cannot take
+# every CPU; requests wait at most PASSWORD_HASH_TIMEOUT seconds for one of
+# PASSWORD_HASH_MAX_PENDING slots before being turned away.
+DEFAULT_CONFIG['PASSWORD_HASH_WORKERS'] = 2
+DEFAULT_CONFIG['PASSWORD_HASH_MAX_PENDING'] = 16
+DEFAULT_CONFIG['PASSWORD_HASH_TIMEOUT'] = 5
+# Rows shown per page in the report viewer, and the most a client may ask for
+DEFAULT_CONFIG['REPORT_PAGE_SIZE'] = 100
+DEFAULT_CONFIG['REPORT_MAX_PAGE_SIZE'] = 1000
+# Threads resizing uploaded product images
+DEFAULT_CONFIG['IMAGE_WORKERS'] = 2
+# How long browsers and CDNs may keep fingerprinted static files and
+# content-addressed uploads, which never change under the same URL
+DEFAULT_CONFIG['IMMUTABLE_MAX_AGE'] = 365 * 24 * 60 * 60
+# Text responses of at least COMPRESSION_MIN_SIZE bytes are compressed with
+# brotli (when the brotli package is installed) or gzip, whichever the client
+# prefers; streamed ones as they are generated. Higher levels trade CPU time
+# per request for smaller responses.
+DEFAULT_CONFIG['COMPRESSION_ENABLED'] = True
+DEFAULT_CONFIG['COMPRESSION_MIN_SIZE'] = 1024
+DEFAULT_CONFIG['COMPRESSION_LEVELS'] = {'br': 4, 'gzip': 6}
+# Rendered product grids kept in memory per worker. Set FRAGMENT_CACHE_PATH
+# to a local SQLite file to also share them between workers on a host.
+DEFAULT_CONFIG['FRAGMENT_CACHE_SIZE'] = 256
+DEFAULT_CONFIG['FRAGMENT_CACHE_PATH'] = None
+# Time spent in SQL, in templates and in the whole handler is sent with every
+# response in a Server-Timing header (shown by browser dev tools) and
+# collected per endpoint into histograms served at /metrics for Prometheus
+DEFAULT_CONFIG['SERVER_TIMING_HEADER'] = True
+DEFAULT_CONFIG['METRICS_ENABLED'] = True
+# /metrics shows route names and timings, so it is only served to admins
+# and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>"
+DEFAULT_CONFIG['METRICS_TOKEN'] = None
+# Opt-in profiling of slow requests: PROFILE_SAMPLE_RATE of requests (0 to 1)
+# run under cProfile, and those taking at least PROFILE_SLOW_THRESHOLD
+# seconds have their profile written to PROFILE_DIR, which keeps the newest
+# PROFILE_MAX_FILES. Profiled requests run slower, so sample sparingly. A
+# relative PROFILE_DIR is taken from the app's directory.
+DEFAULT_CONFIG['PROFILE_SAMPLE_RATE'] = 0
+DEFAULT_CONFIG['PROFILE_SLOW_THRESHOLD'] = 0.5
+DEFAULT_CONFIG['PROFILE_DIR'] = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'profiles')
+DEFAULT_CONFIG['PROFILE_MAX_FILES'] = 200
 
 UPLOAD_FOLDER = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), 'uploads') 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER 
-
-os.makedirs(UPLOAD_FOLDER, exist_ok=True) 
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
+DEFAULT_CONFIG['UPLOAD_FOLDER'] = UPLOAD_FOLDER 
+DEFAULT_CONFIG['REPORT_FOLDER'] = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'reports')
+# Uploaded images and generated reports are kept by a storage backend (see
+# storage.py). 'local' keeps them in UPLOAD_FOLDER and REPORT_FOLDER; 's3'
+# keeps them under the uploads/ and reports/ prefixes of S3_BUCKET, on AWS or
+# any S3-compatible server at S3_ENDPOINT_URL, so every worker and host sees
+# the same files. Downloads from S3 are redirects to presigned URLs unless
+# S3_PRESIGNED_URLS is off, in which case they are streamed through the app.
+DEFAULT_CONFIG['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'local')
+DEFAULT_CONFIG['S3_BUCKET'] = os.environ.get('S3_BUCKET')
+DEFAULT_CONFIG['S3_ENDPOINT_URL'] = os.environ.get('S3_ENDPOINT_URL')
+DEFAULT_CONFIG['S3_REGION'] = os.environ.get('S3_REGION')
+DEFAULT_CONFIG['S3_PRESIGNED_URLS'] = True
+DEFAULT_CONFIG['S3_PRESIGNED_URL_EXPIRY'] = 300  # Seconds
+# Local copies of S3 objects that are needed as files (image resizing and
+# the report index)
+DEFAULT_CONFIG['STORAGE_CACHE_DIR'] = os.path.join(
+    tempfile.gettempdir(), 'thrift-and-thrive')
+# Compiled templates are cached here so a new process, a serverless cold
+# start in particular, does not compile them again. None turns it off.
+DEFAULT_CONFIG['TEMPLATE_CACHE_DIR'] = os.path.join(
+    tempfile.gettempdir(), 'thrift-and-thrive', 'templates')
+
+
+def make_storage(config, name, local_folder):
+    if config['STORAGE_BACKEND'] == 's3':
+        return S3Storage(
+            config['S3_BUCKET'], prefix=f'{name}/',
+            cache_dir=os.path.join(config['STORAGE_CACHE_DIR'], name),
+            endpoint_url=config['S3_ENDPOINT_URL'],
+            region=config['S3_REGION'],
+            presigned_urls=config['S3_PRESIGNED_URLS'],
+            presigned_url_expiry=config['S3_PRESIGNED_URL_EXPIRY'])
+    return LocalStorage(local_folder)
+
+
+class RoutingSession(Session):
+    """Sends queries made by read-only views to the 'read' engine.
+
+    Writes, and everything outside a @read_only request (including
+    background jobs), use the default engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context()
+                and g.get('read_only')
+                and current_app.config['USE_READ_ENGINE']):
+            return self._db.engines['read']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+bcrypt = Bcrypt()
+# Every route, hook and command; create_app() registers it on each app
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+def app_resource(name):
+    """Proxy to a resource create_app() built for the current app."""
+    return LocalProxy(
+        lambda: current_app.extensions['thrift_and_thrive'][name])
+
+
+upload_storage = app_resource('upload_storage')
+report_storage = app_resource('report_storage')
+image_pipeline = app_resource('image_pipeline')
+password_executor = app_resource('password_executor')
+password_slots = app_resource('password_slots')
+fragment_cache = app_resource('fragment_cache')
+profile_store = app_resource('profile_store')
+
+
+def is_memory_database(url):
+    url = make_url(url)
+    return (url.get_backend_name() == 'sqlite'
+            and (url.database in (None, '', ':memory:')
+                 or url.query.get('mode') == 'memory'))
+
+
+def pool_options(url, options):
+    """Return the pool settings in ``options`` that apply to ``url``.
+
+    In-memory SQLite databases live in a single shared connection that
+    takes no pool sizing, and connections to local SQLite files cannot go
+    stale, so pre-ping is only kept for database servers.
+    """
+    if is_memory_database(url):
+        return {}
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {name: value for name, value in options.items()
+                if name != 'pool_pre_ping'}
+    return dict(options)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in current_app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def set_query_only(dbapi_connection, connection_record):
+    # Guarantees nothing routed to the read engine can write
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
 
 
 class User(db.Model):
@@ -35,7 +301,8 @@ class User(db.Model):
 
 class Address(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) 
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False,
+                        index=True) 
     street = db.Column(db.String(200), nullable=False)
     city = db.Column(db.String(100), nullable=False)
     state = db.Column(db.String(100), nullable=False)
@@ -49,6 +316,16 @@ class Address(db.Model):
 
 
 class Product(db.Model):
+    __table_args__ = (
+        # Catalog filters, each with the id the pages are ordered by
+        db.Index('ix_product_condition_id', 'condition', 'id'),
+        db.Index('ix_product_price_id', 'price', 'id'),
+        db.Index('ix_product_rating_id', 'rating', 'id'),
+        # Orders keep the ids of deleted products, so ids must never be
+        # reused
+        {'sqlite_autoincrement': True},
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
@@ -56,25 +333,42 @@ class Product(db.Model):
     condition = db.Column(db.String(20), nullable=False)
     rating = db.Column(db.Float, default=0)
     image_filename = db.Column(db.String(100), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) 
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False,
+                        index=True) 
 
 
 class Cart(db.Model):
+    # A product is in a user's cart at most once
+    __table_args__ = (
+        db.Index('uq_cart_user_product', 'user_id', 'product_id',
+                 unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), 
-                           nullable=False)
+                           nullable=False, index=True)
     quantity = db.Column(db.Integer, default=1)
 
 
 class PurchaseEvent(db.Model):
     __tablename__ = 'purchase_event'
+    # Order history by user, newest first
+    __table_args__ = (
+        db.Index('ix_purchase_event_user_date', 'user_id', 'purchase_date'),
+        db.Index('uq_purchase_event_idempotency_key', 'user_id',
+                 'idempotency_key', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     address_id = db.Column(db.Integer, db.ForeignKey('address.id'), 
                            nullable=False)
-    purchase_date = db.Column(db.DateTime, default=datetime.utcnow)
+    purchase_date = db.Column(db.DateTime, default=datetime.utcnow,
+                              index=True)
+    # Sent by the client with each checkout attempt, so a retried request
+    # returns the original order instead of placing a second one
+    idempotency_key = db.Column(db.String(64))
 
     user = db.relationship('User', backref='purchase_events')
     address = db.relationship('Address', backref='purchase_events')
@@ -87,62 +381,692 @@ class Purchase(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     purchase_event_id = db.Column(db.Integer, db.ForeignKey(
-        'purchase_event.id'), nullable=False)
+        'purchase_event.id'), nullable=False, index=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), 
-                           nullable=False)
+                           nullable=False, index=True)
     quantity = db.Column(db.Integer, default=1)
+    # What one unit cost when the order was placed; the product's price may
+    # change or the product be deleted later
+    unit_price = db.Column(db.Float)
 
     product = db.relationship('Product', backref='purchases')
 
 
+# Sales totals per day and per product per day, updated with every order so
+# the dashboard never has to aggregate the purchase history. Revenue is taken
+# at the product's price when it was bought. Product rows keep no foreign key
+# because the totals outlive deleted products.
+class DailySales(db.Model):
+    __tablename__ = 'daily_sales'
+
+    day = db.Column(db.Date, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
+class ProductSales(db.Model):
+    __tablename__ = 'product_sales'
+
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+
 # Model to store report files
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    file_path = db.Column(db.String(200), nullable=False)
+    file_path = db.Column(db.String(200), nullable=False)  # Storage key
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Single-row counter bumped whenever products are added or removed; cached
+# catalog pages are keyed by it
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Model to track background jobs started from the admin dashboard
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)  # Percent
+    message = db.Column(db.String(500))
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    # The process running the job, and when it last showed it was alive
+    owner = db.Column(db.String(100))
+    heartbeat_at = db.Column(db.DateTime)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+
+# Full-text search index over Product.name and Product.description. It is an
+# external-content FTS5 table, so it only stores the index and has to be kept
+# in sync explicitly whenever products are added or removed.
+PRODUCT_SEARCH_TABLE = 'product_fts'
+
+
+def search_index_available():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def setup_search_index():
+    if not search_index_available():
+        return
+    exists = db.session.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': PRODUCT_SEARCH_TABLE}).first()
+    if exists:
+        return
+    db.session.execute(db.text(
+        f"CREATE VIRTUAL TABLE {PRODUCT_SEARCH_TABLE} USING fts5("
+        "name, description, content='product', content_rowid='id')"))
+    # Index any products that existed before the search table did
+    rebuild_search_index()
+    db.session.commit()
+
+
+def rebuild_search_index():
+    """Reindex every product from scratch (caller commits)."""
+    if not search_index_available():
+        return
+    db.session.execute(db.text(
+        f"INSERT INTO {PRODUCT_SEARCH_TABLE}({PRODUCT_SEARCH_TABLE}) "
+        "VALUES ('rebuild')"))
+
+
+def index_products(product_ids):
+    """Add the given products to the search index (caller commits)."""
+    if not search_index_available() or not product_ids:
+        return
+    db.session.execute(db.text(
+        f"INSERT INTO {PRODUCT_SEARCH_TABLE}(rowid, name, description) "
+        "SELECT id, name, description FROM product WHERE id IN :ids"
+    ).bindparams(db.bindparam('ids', expanding=True)),
+        {'ids': list(product_ids)})
+
+
+def unindex_products(product_ids):
+    """Remove products from the search index (caller commits).
+
+    The index keeps no copy of the text and deleting an entry takes the
+    values it was indexed with, so this runs before the products go.
+    """
+    if not search_index_available() or not product_ids:
+        return
+    db.session.execute(db.text(
+        f"INSERT INTO {PRODUCT_SEARCH_TABLE}"
+        f"({PRODUCT_SEARCH_TABLE}, rowid, name, description) "
+        "SELECT 'delete', id, name, description FROM product WHERE id IN :ids"
+    ).bindparams(db.bindparam('ids', expanding=True)),
+        {'ids': list(product_ids)})
+
+
+def setup_catalog_version():
+    if not db.session.get(CatalogVersion, 1):
+        db.session.add(CatalogVersion(id=1, version=0))
+        db.session.commit()
+
+
+JOB_ACTIVE_STATUSES = ('queued', 'running')
 
 
-with app.app_context():
+def fail_interrupted_jobs():
+    """Mark jobs left active by a previous process as failed."""
+    Job.query.filter(Job.status.in_(JOB_ACTIVE_STATUSES)).update(
+        {'status': 'failed', 'message': 'Interrupted by a server restart.',
+         'finished_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+
+def setup_database():
+    """Create missing tables and bring an existing schema up to date."""
     db.create_all()
+    with db.engine.begin() as connection:
+        applied = migrations.upgrade(connection)
+    setup_search_index()
+    setup_catalog_version()
+    return applied
+
+
+@bp.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = setup_database()
+    # Run on deploy, when no process is left to finish active jobs
+    fail_interrupted_jobs()
+    if applied:
+        click.echo(f"Applied migrations: {', '.join(map(str, applied))}")
+    else:
+        click.echo("Database schema is up to date.")
+
+
+def get_current_user():
+    """Return the logged-in User, loading it at most once per request."""
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        g.current_user = db.session.get(User, user_id) if user_id else None
+    return g.current_user
+
+
+def get_cart_count():
+    """Return the number of items in the user's cart, cached per request.
+
+    With CACHE_CART_COUNT_IN_SESSION the count is also kept in the session
+    until the cart changes, so most pages skip the COUNT query entirely.
+    """
+    if 'cart_count' not in g:
+        user_id = session.get('user_id')
+        use_session = current_app.config['CACHE_CART_COUNT_IN_SESSION']
+        if not user_id:
+            g.cart_count = 0
+        elif use_session and 'cart_count' in session:
+            g.cart_count = session['cart_count']
+        else:
+            g.cart_count = Cart.query.filter_by(user_id=user_id).count()
+            if use_session:
+                session['cart_count'] = g.cart_count
+    return g.cart_count
+
+
+def get_catalog_version():
+    """Return the current catalog version, read once per request."""
+    if 'catalog_version' not in g:
+        g.catalog_version = db.session.execute(
+            db.select(CatalogVersion.version).where(CatalogVersion.id == 1)
+        ).scalar()
+    return g.catalog_version
+
+
+def bump_catalog_version():
+    """Mark the catalog as changed, in the caller's transaction."""
+    db.session.execute(db.update(CatalogVersion).where(
+        CatalogVersion.id == 1).values(version=CatalogVersion.version + 1))
+    g.pop('catalog_version', None)
+    forget_catalog_version()
+
+
+# The catalog version this process read last and when (time.monotonic())
+last_catalog_version = {'version': None, 'read_at': 0.0}
+
+
+def remember_catalog_version(version):
+    last_catalog_version.update(version=version, read_at=time.monotonic())
+
+
+def forget_catalog_version():
+    last_catalog_version.update(version=None, read_at=0.0)
+
+
+def recent_catalog_version():
+    """Return the last catalog version read by this process, if recent.
+
+    None means the version has to be read from the database.
+    """
+    version, read_at = (last_catalog_version['version'],
+                        last_catalog_version['read_at'])
+    max_age = current_app.config['API_CATALOG_VERSION_MAX_AGE']
+    if time.monotonic() - read_at > max_age:
+        return None
+    return version
+
+
+def invalidate_cart_count():
+    """Forget the cached cart count after the cart has been changed."""
+    g.pop('cart_count', None)
+    session.pop('cart_count', None)
+
+
+def read_only(f):
+    """Run the view's queries on the read engine."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
+
 
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_request_queries(conn, cursor, statement, parameters, context,
+                          executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_request_queries(conn, cursor, statement, parameters, context,
+                         executemany):
+    if has_request_context() and conn.info.get('query_started'):
+        started = conn.info['query_started'].pop()
+        g.query_time = g.get('query_time', 0.0) + (
+            time.perf_counter() - started)
+
+
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+
+def stop_template_timer(sender, template, context, **extra):
+    if g.get('template_started'):
+        started = g.template_started.pop()
+        g.template_time = g.get('template_time', 0.0) + (
+            time.perf_counter() - started)
+
+
+metrics_registry = Registry()
+request_duration = metrics_registry.histogram(
+    'http_request_duration_seconds',
+    "Time spent handling a request, before any streamed body is sent.",
+    'endpoint')
+query_duration = metrics_registry.histogram(
+    'db_query_duration_seconds',
+    "Time spent running SQL statements while handling a request.",
+    'endpoint')
+query_count = metrics_registry.histogram(
+    'db_queries_per_request', "SQL statements run while handling a request.",
+    'endpoint', COUNT_BUCKETS)
+render_duration = metrics_registry.histogram(
+    'template_render_duration_seconds',
+    "Time spent rendering templates while handling a request.", 'endpoint')
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_timings(response):
+    started = g.get('request_started')
+    if started is None or request.endpoint == 'main.metrics':
+        return response
+    total = time.perf_counter() - started
+    queries = g.get('query_count', 0)
+    sql_time = g.get('query_time', 0.0)
+    template_time = g.get('template_time', 0.0)
+
+    if current_app.config['METRICS_ENABLED']:
+        endpoint = request.endpoint or 'unmatched'
+        request_duration.observe(endpoint, total)
+        query_duration.observe(endpoint, sql_time)
+        query_count.observe(endpoint, queries)
+        render_duration.observe(endpoint, template_time)
+
+    if current_app.config['SERVER_TIMING_HEADER']:
+        response.headers['Server-Timing'] = ', '.join([
+            f'sql;dur={sql_time * 1000:.1f};desc="{queries} queries"',
+            f'render;dur={template_time * 1000:.1f};desc="Templates"',
+            f'app;dur={total * 1000:.1f};desc="Handler"',
+        ])
+    return response
+
+
+# Not worth profiling, and profiling the profile viewer would rotate away
+# the profiles being looked at
+UNPROFILED_ENDPOINTS = {'static', 'main.metrics', 'main.request_profiles',
+                        'main.request_profile'}
+
+
+# Held by the request being profiled. Since Python 3.12 profilers share
+# sys.monitoring, and enabling a second one raises ValueError, so requests
+# sampled while another is profiled are skipped.
+profiler_lock = threading.Lock()
+
+
+@bp.before_app_request
+def start_request_profiler():
+    rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if (rate and request.endpoint not in UNPROFILED_ENDPOINTS
+            and random.random() < rate
+            and profiler_lock.acquire(blocking=False)):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # Another profiler or debugger is active
+            profiler_lock.release()
+            return
+        g.profiler = profiler
+
+
+def stop_profiler(profiler):
+    profiler.disable()
+    profiler_lock.release()
+
+
+@bp.after_app_request
+def save_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    stop_profiler(profiler)
+    duration = time.perf_counter() - g.request_started
+    if duration < current_app.config['PROFILE_SLOW_THRESHOLD']:
+        return response
+    try:
+        profile_store.save(profiler, {
+            'endpoint': request.endpoint or 'unmatched',
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'duration': round(duration, 4),
+            'queries': g.get('query_count', 0),
+            'sql_time': round(g.get('query_time', 0.0), 4),
+            'recorded_at': datetime.utcnow().isoformat(timespec='seconds'),
+        })
+    except OSError:
+        current_app.logger.exception("Could not save the profile of %s",
+                                     request.path)
+    return response
+
+
+@bp.teardown_app_request
+def stop_request_profiler(error):
+    # Only still running if the request failed before after_request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        stop_profiler(profiler)
+
+
+@bp.route('/metrics')
+def metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        return render_template('404.html'), 404
+    token = current_app.config['METRICS_TOKEN']
+    authorization = request.authorization
+    if not (token and authorization and authorization.type == 'bearer'
+            and hmac.compare_digest(authorization.token or '', token)):
+        user = get_current_user()
+        if not user or not user.is_admin:
+            return Response('Unauthorized\n', status=401,
+                            headers={'WWW-Authenticate': 'Bearer'},
+                            content_type='text/plain; charset=utf-8')
+    return Response(metrics_registry.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """Handed to job handlers to report progress and notice cancellation.
+
+    Progress is written to the Job row, so every process sees it, at most
+    every JOB_PROGRESS_INTERVAL seconds and on a connection of its own. The
+    same write renews the job's heartbeat and reads its cancel flag. Report
+    progress between transactions: on SQLite the write would wait for a
+    transaction of the handler's own that has written something.
+    """
+
+    def __init__(self, job_id, params):
+        self.job_id = job_id
+        self.params = params
+        self._last_write = 0.0
+        self._pending = {}
+
+    def progress(self, done, total, message=None):
+        """Record progress and raise JobCancelled if a cancel was asked."""
+        percent = int(done * 100 / total) if total else 100
+        self._pending['progress'] = min(percent, 100)
+        if message:
+            self._pending['message'] = message[:500]
+        self.check_cancelled()
+
+    def check_cancelled(self):
+        now = time.monotonic()
+        interval = current_app.config['JOB_PROGRESS_INTERVAL']
+        if now - self._last_write < interval:
+            return
+        self._last_write = now
+        values, self._pending = self._pending, {}
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Job).where(
+                Job.id == self.job_id).values(
+                heartbeat_at=datetime.utcnow(), **values))
+            cancelled = connection.execute(
+                db.select(Job.cancel_requested).where(Job.id == self.job_id)
+            ).scalar()
+        if cancelled:
+            raise JobCancelled()
+
+
+# Registered job handlers by kind, and the jobs this process has queued or
+# running, whose heartbeat it renews
+JOB_HANDLERS = {}
+owned_jobs = app_resource('owned_jobs')
+owned_jobs_lock = threading.Lock()
+job_executor_lock = threading.Lock()
+
+
+def job_handler(kind):
+    """Register a function as the handler for jobs of the given kind.
+
+    The handler receives a JobContext and returns a message for the admin.
+    """
+    def decorator(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def job_owner():
+    """Name the current process in the jobs it runs."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def renew_job_heartbeats(app):
+    """Renew the heartbeat of this process's jobs until it exits."""
+    while True:
+        time.sleep(app.config['JOB_HEARTBEAT_INTERVAL'])
+        with app.app_context():
+            with owned_jobs_lock:
+                job_ids = list(owned_jobs)
+            if not job_ids:
+                continue
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(db.update(Job).where(
+                        Job.id.in_(job_ids)).values(
+                        heartbeat_at=datetime.utcnow()))
+            except Exception:
+                app.logger.exception(
+                    "Could not renew the heartbeat of jobs %s", job_ids)
+
+
+def get_job_executor():
+    """Return the app's job worker pool, started on first use."""
+    resources = current_app.extensions['thrift_and_thrive']
+    with job_executor_lock:
+        if resources['job_executor'] is None:
+            resources['job_executor'] = ThreadPoolExecutor(
+                max_workers=current_app.config['JOB_WORKERS'],
+                thread_name_prefix='job')
+            threading.Thread(target=renew_job_heartbeats,
+                             args=(current_app._get_current_object(),),
+                             name='job-heartbeat', daemon=True).start()
+        return resources['job_executor']
+
+
+def enqueue_job(kind, **params):
+    """Persist a new job and hand it to the worker pool."""
+    job = Job(kind=kind, params=json.dumps(params),
+              created_by=session.get('user_id'), owner=job_owner(),
+              heartbeat_at=datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
 
-@app.route('/')
+    with owned_jobs_lock:
+        owned_jobs.add(job.id)
+    app = current_app._get_current_object()
+    if app.config['JOBS_RUN_INLINE']:
+        run_job(app, job.id)
+    else:
+        get_job_executor().submit(run_job, app, job.id)
+    return job
+
+
+def job_abandoned(job):
+    """Whether an active job's process stopped renewing its heartbeat."""
+    if job.status not in JOB_ACTIVE_STATUSES:
+        return False
+    timeout = timedelta(seconds=current_app.config['JOB_HEARTBEAT_TIMEOUT'])
+    return (job.heartbeat_at is None
+            or job.heartbeat_at < datetime.utcnow() - timeout)
+
+
+def purge_rows(job, model, noun, delete_dependents=None):
+    """Delete every row of ``model`` that exists when the purge starts.
+
+    Rows go PURGE_BATCH_SIZE at a time, each batch in its own short
+    transaction together with ``delete_dependents(ids)``, which deals with
+    the rows referring to the batch. The data is consistent after every
+    batch, so cancelling the job between batches is safe. Rows added while
+    the purge runs are kept. Returns the number of rows deleted.
+    """
+    last_id = db.session.scalar(db.select(db.func.max(model.id))) or 0
+    total = db.session.scalar(db.select(db.func.count()).select_from(
+        model).where(model.id <= last_id))
+    deleted = 0
+    while True:
+        ids = db.session.scalars(db.select(model.id).where(
+            model.id <= last_id).order_by(model.id).limit(
+            current_app.config['PURGE_BATCH_SIZE'])).all()
+        # End the read so the batch's transaction starts with a write and
+        # waits for the lock instead of failing on a stale snapshot
+        db.session.commit()
+        if not ids:
+            return deleted
+        if delete_dependents:
+            delete_dependents(ids)
+        db.session.execute(db.delete(model).where(model.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+        job.progress(deleted, total, f"Deleted {deleted} of {total} {noun}.")
+        time.sleep(current_app.config['PURGE_BATCH_PAUSE'])
+
+
+def finish_job(job_id, status, message):
+    job = db.session.get(Job, job_id)
+    job.status = status
+    job.message = message[:500] if message else message
+    if status == 'done':
+        job.progress = 100
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def run_job(app, job_id):
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        if job.cancel_requested:
+            finish_job(job_id, 'cancelled', 'Cancelled before it started.')
+            return
+        job.status = 'running'
+        db.session.commit()
+
+        context = JobContext(job_id, json.loads(job.params))
+        try:
+            message = JOB_HANDLERS[job.kind](context)
+        except JobCancelled:
+            db.session.rollback()
+            finish_job(job_id, 'cancelled', 'Cancelled.')
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Job %s (%s) failed", job_id, job.kind)
+            finish_job(job_id, 'failed', str(e))
+        else:
+            finish_job(job_id, 'done', message)
+        finally:
+            with owned_jobs_lock:
+                owned_jobs.discard(job_id)
+
+
+def serialize_job(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "message": job.message,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+def query_budget(max_queries):
+    """Guard a view against N+1 regressions.
+
+    Counts every SQL statement run while handling the request (including
+    template rendering). A view exceeding ``max_queries`` is logged as a
+    warning in production; it raises RuntimeError only when
+    ENFORCE_QUERY_BUDGETS or TESTING is set, as in benchmarks.py.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            response = f(*args, **kwargs)
+            query_count = g.get('query_count', 0)
+            if query_count > max_queries:
+                message = (f"{request.endpoint} ran {query_count} queries, "
+                           f"budget is {max_queries}")
+                if (current_app.config['ENFORCE_QUERY_BUDGETS']
+                        or current_app.testing):
+                    raise RuntimeError(message)
+                current_app.logger.warning(message)
+            return response
+        return decorated_function
+    return decorator
+
+
+@bp.route('/')
 def home():
     return render_template('index.html')
 
 
-@app.route('/about')
+@bp.route('/about')
 def about():
     return render_template('about.html')
 
 
-@app.route('/contact')
+@bp.route('/contact')
 def contact():
     return render_template('contact.html')
 
 
-@app.route('/profile', methods=['GET'])
+@bp.route('/profile', methods=['GET'])
+@query_budget(6)
 def profile():
     if 'user_id' not in session:
         flash("Please log in to view your profile.", "error")
-        return redirect(request.referrer or url_for('home'))
+        return redirect(request.referrer or url_for('main.home'))
     
-    user = User.query.get(session['user_id'])
+    user = get_current_user()
     # Load the user's addresses
     user_addresses = Address.query.filter_by(user_id=user.id).all()
-    # Load the user's purchase events
-    purchase_events = PurchaseEvent.query.filter_by(user_id=user.id).all()
+    # Load the user's purchase events together with their address, items and
+    # products, so the order history renders without a query per row
+    purchase_events = PurchaseEvent.query.options(
+        joinedload(PurchaseEvent.address),
+        selectinload(PurchaseEvent.purchases).joinedload(Purchase.product)
+    ).filter_by(user_id=user.id).all()
 
     return render_template('profile.html', user=user, addresses=user_addresses, 
                            purchase_events=purchase_events)
 
 
-@app.route('/add_address', methods=['POST'])
+@bp.route('/add_address', methods=['POST'])
 def add_address():
     if 'user_id' not in session:
         flash("Please log in to view your cart.", "error")
-        return redirect(request.referrer or url_for('home'))
-    user = User.query.get(session['user_id'])
+        return redirect(request.referrer or url_for('main.home'))
+    user = get_current_user()
     # Handling address addition
     street = request.form.get('street')
     city = request.form.get('city')
@@ -168,64 +1092,487 @@ def add_address():
         flash('Address added successfully!', 'success')
     else:
         flash('Please fill all required fields.', 'danger')
-    return redirect(url_for('profile'))
+    return redirect(url_for('main.profile'))
 
 
-@app.route('/delete_address/<int:address_id>', methods=['POST'])
+@bp.route('/delete_address/<int:address_id>', methods=['POST'])
 def delete_address(address_id):
     if 'user_id' not in session:
         flash("Please log in to view your cart.", "error")
-        return redirect(request.referrer or url_for('home'))
-    user = User.query.get(session['user_id'])
+        return redirect(request.referrer or url_for('main.home'))
+    user = get_current_user()
     address = Address.query.get_or_404(address_id)
 
     if address.user_id != user.id:
         flash("You don't have permission to delete this address.", 'danger')
-        return redirect(url_for('profile'))
+        return redirect(url_for('main.profile'))
     
     db.session.delete(address)
     db.session.commit()
     flash('Address deleted successfully!', 'success')
-    return redirect(url_for('profile'))
+    return redirect(url_for('main.profile'))
+
+
+PRODUCT_CONDITIONS = ["New", "Like New", "Used"]
+
+
+def parse_catalog_filters(args):
+    """Read the catalog filters from the query string.
+
+    Invalid values are dropped instead of raising, so a bad link just shows
+    an unfiltered page.
+    """
+    filters = {}
+    for key in ('min_price', 'max_price', 'min_rating'):
+        value = args.get(key, type=float)
+        if value is not None:
+            filters[key] = value
+    condition = args.get('condition')
+    if condition in PRODUCT_CONDITIONS:
+        filters['condition'] = condition
+    return filters
+
+
+def apply_catalog_filters(query, filters):
+    if 'min_price' in filters:
+        query = query.filter(Product.price >= filters['min_price'])
+    if 'max_price' in filters:
+        query = query.filter(Product.price <= filters['max_price'])
+    if 'condition' in filters:
+        query = query.filter(Product.condition == filters['condition'])
+    if 'min_rating' in filters:
+        query = query.filter(Product.rating >= filters['min_rating'])
+    return query
+
+
+def get_page_size(args):
+    per_page = (args.get('per_page', type=int)
+                or current_app.config['SHOP_PAGE_SIZE'])
+    return max(1, min(per_page, current_app.config['SHOP_MAX_PAGE_SIZE']))
+
+
+def fetch_catalog_page(filters, after_id=None, per_page=None):
+    """Return one page of products, newest first, and the next cursor.
+
+    Uses keyset pagination on the product id so the cost of a page does not
+    grow with how deep into the catalog the visitor is. The seller is joined
+    in for the products on this page only.
+    """
+    per_page = per_page or current_app.config['SHOP_PAGE_SIZE']
+    query = apply_catalog_filters(
+        Product.query.options(joinedload(Product.user)), filters)
+    if after_id is not None:
+        query = query.filter(Product.id < after_id)
+
+    # Fetch one extra row to know whether there is a next page
+    products = query.order_by(Product.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(products) > per_page:
+        products = products[:per_page]
+        next_cursor = products[-1].id
+    return products, next_cursor
+
+
+def build_match_query(text):
+    """Turn free text into a safe FTS5 MATCH expression.
+
+    Every word is quoted (so FTS5 operators typed by the user are treated as
+    plain text) and prefix-matched, and all words must match.
+    """
+    words = [word.replace('"', '') for word in text.split()]
+    return ' '.join(f'"{word}"*' for word in words if word)
+
+
+def search_products(text, filters, page=1, per_page=None):
+    """Return one page of products matching ``text``, best match first."""
+    per_page = per_page or current_app.config['SHOP_PAGE_SIZE']
+    query = apply_catalog_filters(
+        Product.query.options(joinedload(Product.user)), filters)
+    match = build_match_query(text)
+    if not match:
+        return [], False
+
+    if search_index_available():
+        # Name matches weigh more than description matches
+        ranked = db.text(
+            f"SELECT rowid, bm25({PRODUCT_SEARCH_TABLE}, 10.0, 1.0) AS rank "
+            f"FROM {PRODUCT_SEARCH_TABLE} WHERE {PRODUCT_SEARCH_TABLE} "
+            "MATCH :match").bindparams(match=match).columns(
+                rowid=db.Integer, rank=db.Float).subquery()
+        query = query.join(ranked, Product.id == ranked.c.rowid).order_by(
+            ranked.c.rank, Product.id.desc())
+    else:
+        for word in text.split():
+            pattern = f'%{word}%'
+            query = query.filter(db.or_(Product.name.ilike(pattern),
+                                        Product.description.ilike(pattern)))
+        query = query.order_by(Product.id.desc())
+
+    products = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    has_next = len(products) > per_page
+    return products[:per_page], has_next
+
+
+@bp.route('/search')
+@read_only
+def search():
+    text = request.args.get('q', '').strip()
+    filters = parse_catalog_filters(request.args)
+    per_page = get_page_size(request.args)
+    page = max(1, request.args.get('page', 1, type=int))
+
+    products, has_next = search_products(text, filters, page, per_page)
+
+    return jsonify({
+        "query": text,
+        "page": page,
+        "has_next": has_next,
+        "results": [
+            {
+                "id": product.id,
+                "name": product.name,
+                "description": product.description,
+                "price": product.price,
+                "condition": product.condition,
+                "rating": product.rating,
+                "image_filename": product.image_filename,
+                "seller": product.user.email
+            } for product in products
+        ]
+    }), 200
+
+
+def render_catalog_grid(filters, per_page, search_text):
+    """Render the product grid and its pagination for the current request.
+
+    The result is the same for every visitor, so it is cached under the
+    catalog version and the page/filter parameters; any catalog change bumps
+    the version and so retires all cached grids at once.
+    """
+    page = max(1, request.args.get('page', 1, type=int))
+    after_id = request.args.get('after', type=int)
+    cache_key = json.dumps([
+        'shop', get_catalog_version(), filters, per_page,
+        search_text, page if search_text else after_id], sort_keys=True)
+    grid_html = fragment_cache.get(cache_key)
+    if grid_html is not None:
+        return Markup(grid_html)
+
+    if search_text:
+        # Search results are ranked, so they are paged by page number
+        products, has_next = search_products(
+            search_text, filters, page, per_page)
+        grid_html = render_template(
+            'product_grid.html', products=products, filters=filters,
+            per_page=per_page, search_text=search_text, page=page,
+            has_next=has_next)
+    else:
+        products, next_cursor = fetch_catalog_page(
+            filters, after_id, per_page)
+        grid_html = render_template(
+            'product_grid.html', products=products, filters=filters,
+            per_page=per_page, next_cursor=next_cursor,
+            is_first_page=not after_id)
+
+    fragment_cache.set(cache_key, grid_html)
+    return Markup(grid_html)
 
 
-@app.route('/shop')
+@bp.route('/shop')
+@read_only
 def shop():
-    products = Product.query.all()
-    users = {user.id: user.email for user in User.query.all()} 
-    return render_template('shop.html', products=products, users=users)
+    filters = parse_catalog_filters(request.args)
+    per_page = get_page_size(request.args)
+    search_text = request.args.get('q', '').strip()
+
+    grid_html = render_catalog_grid(filters, per_page, search_text)
+
+    return render_template('shop.html', grid_html=grid_html, filters=filters,
+                           conditions=PRODUCT_CONDITIONS,
+                           search_text=search_text)
+
+
+# Bumped whenever the API's JSON changes shape, so clients do not keep
+# copies in the old format
+API_FORMAT_VERSION = 1
+
+# Fields a client can select with ?fields=, and the columns they come from
+API_PRODUCT_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'description': Product.description,
+    'price': Product.price,
+    'condition': Product.condition,
+    'rating': Product.rating,
+    'image_url': Product.image_filename,
+    'seller': User.email,
+}
+
+
+def parse_api_fields(args):
+    """Return the fields asked for with ?fields=, all of them by default.
+
+    Raises ValueError naming any unknown field.
+    """
+    text = args.get('fields', '').strip()
+    if not text:
+        return list(API_PRODUCT_FIELDS)
+    fields = list(dict.fromkeys(
+        field.strip() for field in text.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in API_PRODUCT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from "
+                         f"{', '.join(API_PRODUCT_FIELDS)}.")
+    return fields
+
+
+def select_api_products(fields):
+    """A SELECT of only the requested fields, plus the id as ``cursor``."""
+    query = db.select(Product.id.label('cursor'), *(
+        API_PRODUCT_FIELDS[field].label(field) for field in fields))
+    if 'seller' in fields:
+        query = query.join(User, Product.user_id == User.id)
+    return query
+
+
+def api_product(row, fields):
+    product = {field: row._mapping[field] for field in fields}
+    if 'image_url' in product:
+        product['image_url'] = url_for(
+            'main.uploaded_file', filename=product['image_url'],
+            _external=True)
+    return product
+
+
+def api_error(message, status):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def conditional_api_response(build):
+    """Answer a catalog API request, with 304 if the client is up to date.
+
+    The strong ETag is derived from the catalog version, which every catalog
+    change bumps, so a copy with the current ETag is still correct. A
+    matching If-None-Match is usually answered from the version this process
+    read last, without a query. ``build`` returns the response for the
+    current version and only runs when the client's copy is out of date.
+    """
+    def etag(version):
+        return f'catalog-{API_FORMAT_VERSION}-{version}'
+
+    version = recent_catalog_version()
+    # Compressed responses carry the ETag as a weak one, so compare weakly
+    if (version is None
+            or not request.if_none_match.contains_weak(etag(version))):
+        # The data below is read in the same transaction as this version
+        version = get_catalog_version()
+        remember_catalog_version(version)
+
+    if request.if_none_match.contains_weak(etag(version)):
+        response = Response(status=304)
+    else:
+        response = build()
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag(version))
+    # Shared caches may keep it, but must check the ETag before reuse
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.route('/api/products')
+@query_budget(2)
+@read_only
+def api_products():
+    """Products, newest first, a page at a time.
+
+    Takes the same filters and ``per_page`` as the shop, ``fields`` to pick
+    the fields returned and ``after``, the ``next_cursor`` of the previous
+    page.
+    """
+    try:
+        fields = parse_api_fields(request.args)
+    except ValueError as error:
+        return api_error(str(error), 400)
+    after_id = request.args.get('after', type=int)
+    if 'after' in request.args and after_id is None:
+        return api_error("The after cursor must be a product id.", 400)
+    filters = parse_catalog_filters(request.args)
+    per_page = get_page_size(request.args)
+
+    def build():
+        query = apply_catalog_filters(select_api_products(fields), filters)
+        if after_id is not None:
+            query = query.filter(Product.id < after_id)
+        # Fetch one extra row to know whether there is a next page
+        rows = db.session.execute(query.order_by(Product.id.desc()).limit(
+            per_page + 1)).all()
+        next_cursor = next_url = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = rows[-1].cursor
+            next_url = url_for('main.api_products', **dict(
+                request.args.to_dict(), after=next_cursor), _external=True)
+        return jsonify({
+            'products': [api_product(row, fields) for row in rows],
+            'next_cursor': next_cursor,
+            'next': next_url,
+        })
+
+    return conditional_api_response(build)
+
+
+@bp.route('/api/products/<int:product_id>')
+@query_budget(2)
+@read_only
+def api_product_detail(product_id):
+    try:
+        fields = parse_api_fields(request.args)
+    except ValueError as error:
+        return api_error(str(error), 400)
+
+    def build():
+        row = db.session.execute(select_api_products(fields).where(
+            Product.id == product_id)).first()
+        if row is None:
+            return api_error("Product not found.", 404)
+        return jsonify(api_product(row, fields))
+
+    return conditional_api_response(build)
+
+
+@bp.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    try:
+        if not upload_storage.exists(filename):
+            # Fall back to the original while its variants are being
+            # generated; that response must not be cached in place of the
+            # variant
+            fallback = original_name(filename)
+            if fallback:
+                response = upload_storage.serve(
+                    fallback, content_type=upload_mimetype(fallback))
+            else:
+                response = upload_storage.serve(
+                    filename, content_type=upload_mimetype(filename))
+        elif is_content_addressed(filename):
+            response = upload_storage.serve(
+                filename, max_age=current_app.config['IMMUTABLE_MAX_AGE'],
+                immutable=True, content_type=upload_mimetype(filename))
+        else:
+            # Older uploads are stored by name, so browsers revalidate them
+            # using their ETag and Last-Modified headers
+            response = upload_storage.serve(
+                filename, content_type=upload_mimetype(filename))
+    except ValueError:  # Not a valid storage key
+        return render_template('404.html'), 404
+    # Uploads are user content on this origin: never let a browser run one
+    # as a page or script
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
 
+@bp.app_template_global()
+def image_srcset(filename, image_format):
+    return srcset(lambda name: url_for('main.uploaded_file', filename=name),
+                  filename, image_format)
 
-@app.route('/thank_you')
+
+@bp.route('/thank_you')
 def thank_you():
     return render_template('thank_you.html')
 
 
 # Error handler for TemplateNotFound
-@app.errorhandler(TemplateNotFound)
+@bp.app_errorhandler(TemplateNotFound)
 def handle_template_not_found(error):
     return render_template('404.html'), 404  # Render a custom 404 page
 
 
-@app.route('/login', methods=['POST'])
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def run_password_task(f, *args):
+    """Run a bcrypt call on the hashing pool and wait for its result.
+
+    bcrypt releases the GIL, so the pool bounds how many CPUs hashing can
+    use. Raises PasswordHasherBusy when every slot stays taken.
+    """
+    if not password_slots.acquire(
+            timeout=current_app.config['PASSWORD_HASH_TIMEOUT']):
+        raise PasswordHasherBusy()
+    try:
+        return password_executor.submit(f, *args).result()
+    finally:
+        password_slots.release()
+
+
+def hash_password(password):
+    return run_password_task(
+        bcrypt.generate_password_hash, password,
+        current_app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
+
+
+def check_password(password_hash, password):
+    return run_password_task(bcrypt.check_password_hash, password_hash,
+                             password)
+
+
+def password_needs_rehash(password_hash):
+    # bcrypt hashes look like $2b$<cost>$<salt and hash>
+    try:
+        cost = int(password_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return cost != current_app.config['BCRYPT_LOG_ROUNDS']
+
+
+def flash_hasher_busy():
+    flash("We are handling a lot of sign-ins right now. "
+          "Please try again in a moment.", "error")
+
+
+@bp.route('/login', methods=['POST'])
 def login():
     email = request.form['email']
     password = request.form['password']
     
     user = User.query.filter_by(email=email).first()
-    if user and bcrypt.check_password_hash(user.password, password):
+    try:
+        valid = user is not None and check_password(user.password, password)
+    except PasswordHasherBusy:
+        flash_hasher_busy()
+        failed_login_redirect = (request.form.get('next')
+                                 or url_for('main.home'))
+        return redirect(f"{failed_login_redirect}?login_failed=true")
+
+    if valid:
+        if password_needs_rehash(user.password):
+            # Upgrade the stored hash to the current cost while the plain
+            # password is at hand; a busy pool just leaves it for next time
+            try:
+                user.password = hash_password(password)
+                db.session.commit()
+            except PasswordHasherBusy:
+                pass
         session['user_id'] = user.id
+        invalidate_cart_count()
         flash("Login successful!", "success")
         # Check if 'next' is valid; if not, default to 'home'
-        next_page = request.form.get('next') or url_for('home')
+        next_page = request.form.get('next') or url_for('main.home')
         return redirect(next_page)
     else:
         flash("Invalid email or password!", "error")
-        failed_login_redirect = request.form.get('next') or url_for('home')
+        failed_login_redirect = (request.form.get('next')
+                                 or url_for('main.home'))
         return redirect(f"{failed_login_redirect}?login_failed=true")
 
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register():
     email = request.form['reg-email']
     password = request.form['reg-password']
@@ -234,41 +1581,56 @@ def register():
     if password != confirm_password:
         flash("Passwords do not match!", "error")
         # Check if 'next' is valid; if not, default to 'home'
-        next_page = request.form.get('next') or url_for('home')
+        next_page = request.form.get('next') or url_for('main.home')
         return redirect(next_page)
 
-    hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-    user = User(email=email, password=hashed_password)
-
+    # Check for an existing account before spending time on hashing
     existing_user = User.query.filter_by(email=email).first()
     if existing_user:
         flash("Email already registered!", "error")
         # Check if 'next' is valid; if not, default to 'home'
-        next_page = request.form.get('next') or url_for('home')
+        next_page = request.form.get('next') or url_for('main.home')
         return redirect(next_page)
 
+    try:
+        hashed_password = hash_password(password)
+    except PasswordHasherBusy:
+        flash_hasher_busy()
+        next_page = request.form.get('next') or url_for('main.home')
+        return redirect(next_page)
+    user = User(email=email, password=hashed_password)
+
     db.session.add(user)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Someone registered the same email while we were hashing
+        db.session.rollback()
+        flash("Email already registered!", "error")
+        next_page = request.form.get('next') or url_for('main.home')
+        return redirect(next_page)
     session['user_id'] = user.id  # Log the user in
+    invalidate_cart_count()
     flash("Registration successful! You are now logged in.", "success")
     # Check if 'next' is valid; if not, default to 'home'
-    next_page = request.form.get('next') or url_for('home')
+    next_page = request.form.get('next') or url_for('main.home')
     return redirect(next_page)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     session.pop('user_id', None)
+    invalidate_cart_count()
     flash("You have been logged out.", "success")
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
 
-@app.route('/sell', methods=['POST'])
+@bp.route('/sell', methods=['POST'])
 def sell_product():
     if 'user_id' not in session:
         # Redirect to login page or return with an error flash
         flash("You need to be logged in to sell items.", "error")
-        return redirect(url_for('shop'))  # Or redirect to the shop page
+        return redirect(url_for('main.shop'))  # Or redirect to the shop page
 
     name = request.form['name']
     description = request.form['description']
@@ -278,10 +1640,12 @@ def sell_product():
     user_id = session['user_id']  # Retrieve user ID from session
 
     if image:
-        # Save the image
-        filename = secure_filename(image.filename)
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        image.save(image_path)
+        # Save the image under its content hash; identical uploads share a file
+        try:
+            filename = store_upload(image, upload_storage)
+        except NotAnImage as error:
+            flash(str(error), "error")
+            return redirect(url_for('main.shop'))
 
         # Create and save the new product in the database
         new_product = Product(
@@ -293,45 +1657,47 @@ def sell_product():
             user_id=user_id  # Associate the product with the user
         )
         db.session.add(new_product)
+        db.session.flush()
+        index_products([new_product.id])
+        bump_catalog_version()
         db.session.commit()
+        # Thumbnails are made in the background; the original is served
+        # until they are ready
+        image_pipeline.submit(upload_storage._get_current_object(), filename)
 
         flash("Product listed successfully!", "success")
-        return redirect(url_for('shop'))
+        return redirect(url_for('main.shop'))
 
     flash("Failed to list the product. Please try again.", "error")
-    return redirect(url_for('shop'))
+    return redirect(url_for('main.shop'))
 
 
-@app.route('/add_to_cart/<int:product_id>', methods=['POST'])
+@bp.route('/add_to_cart/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     if 'user_id' not in session:
         # Redirect to login page or return with an error flash
         flash("You need to be logged in to add items to your cart.", "error")
-        return redirect(url_for('shop'))  # Or redirect to the shop page
+        return redirect(url_for('main.shop'))  # Or redirect to the shop page
 
     user_id = session['user_id']
-    cart_item = Cart.query.filter_by(
-        user_id=user_id, product_id=product_id).first()
-    
-    if cart_item:
-        # Item is already in the cart, flash an error message
-        flash("Item already exists in your cart!", "error")
+    if not db.session.get(Product, product_id):
+        flash("Product not found.", "error")
     else:
-        # Item is not in the cart, add it as a new item
-        cart_item = Cart(user_id=user_id, product_id=product_id, quantity=1)
-        db.session.add(cart_item)
+        # Like /cart/batch, adding an item already in the cart adds one more
+        cart_upsert(user_id, product_id, 1, increment=True)
         db.session.commit()
+        invalidate_cart_count()
         flash("Item successfully added to your cart.", "success")
     
     # Redirect to the 'shop' page or another relevant page
-    return redirect(url_for('shop'))
+    return redirect(url_for('main.shop'))
 
 
-@app.route('/cart')
+@bp.route('/cart')
 def cart():
     if 'user_id' not in session:
         flash("Please log in to view your cart.", "error")
-        return redirect(request.referrer or url_for('home'))
+        return redirect(request.referrer or url_for('main.home'))
 
     user_id = session['user_id']
     # Get all cart items for the user, along with product details
@@ -373,11 +1739,11 @@ def cart():
     )
 
 
-@app.route('/updateitem', methods=['POST'])
+@bp.route('/updateitem', methods=['POST'])
 def updateitem():
     if 'user_id' not in session:
         flash("Please log in to manage your cart.", "error")
-        return redirect(url_for('cart'))  
+        return redirect(url_for('main.cart'))  
 
     product_id = request.form.get('product_id')
     action = request.form.get('action')
@@ -387,6 +1753,7 @@ def updateitem():
         # Remove the item from the cart
         Cart.query.filter_by(user_id=user_id, product_id=product_id).delete()
         db.session.commit()
+        invalidate_cart_count()
         flash("Item removed from your cart.", "success")
     
     elif action == "update":
@@ -394,19 +1761,131 @@ def updateitem():
         quantity = request.form.get('quantity', type=int)
         cart_item = Cart.query.filter_by(
             user_id=user_id, product_id=product_id).first()
-        if cart_item:
+        if not quantity or quantity < 1:
+            flash("Please enter a quantity of at least 1.", "error")
+        elif cart_item:
             cart_item.quantity = quantity
             db.session.commit()
+            invalidate_cart_count()
             flash("Cart updated successfully.", "success")
     
-    return redirect(url_for('cart'))
+    return redirect(url_for('main.cart'))
+
+
+CART_ACTIONS = ('add', 'update', 'remove')
+
+
+def upsert_insert():
+    """Return the dialect's insert(), which supports ON CONFLICT."""
+    # Imported here: loading the PostgreSQL dialect slows down startup
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def cart_upsert(user_id, product_id, quantity, increment):
+    """Insert a cart row, or change the quantity of the existing one.
+
+    With ``increment`` the quantity is added to the current one, otherwise
+    it replaces it. Relies on the unique (user_id, product_id) index.
+    """
+    statement = upsert_insert()(Cart).values(
+        user_id=user_id, product_id=product_id, quantity=quantity)
+    new_quantity = statement.excluded.quantity
+    if increment:
+        new_quantity = Cart.quantity + statement.excluded.quantity
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['user_id', 'product_id'],
+        set_={'quantity': new_quantity}))
+
+
+def get_cart_summary(user_id):
+    count, total_items, total_price = db.session.query(
+        db.func.count(Cart.id),
+        db.func.coalesce(db.func.sum(Cart.quantity), 0),
+        db.func.coalesce(db.func.sum(Cart.quantity * Product.price), 0)
+    ).outerjoin(Product, Cart.product_id == Product.id).filter(
+        Cart.user_id == user_id).one()
+    return {"cart_count": count, "total_items": total_items,
+            "total_price": round(total_price, 2)}
+
+
+def parse_cart_operations(payload):
+    """Validate a batch of cart operations; returns (operations, error)."""
+    operations = payload.get('operations') if isinstance(payload, dict) \
+        else None
+    if not isinstance(operations, list) or not operations:
+        return None, "Expected a non-empty 'operations' list."
+    if len(operations) > current_app.config['CART_BATCH_MAX_OPERATIONS']:
+        return None, (
+            f"At most {current_app.config['CART_BATCH_MAX_OPERATIONS']} "
+            "operations are allowed per request.")
+
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            return None, "Each operation must be an object."
+        action = operation.get('action')
+        product_id = operation.get('product_id')
+        quantity = operation.get('quantity', 1)
+        if action not in CART_ACTIONS:
+            return None, f"Unknown action: {action!r}."
+        # bool is a subclass of int, but true is not a quantity
+        if (not isinstance(product_id, int) or not isinstance(quantity, int)
+                or isinstance(product_id, bool)
+                or isinstance(quantity, bool)):
+            return None, "product_id and quantity must be integers."
+        if action == 'add' and quantity < 1:
+            return None, "Added quantity must be at least 1."
+        parsed.append((action, product_id, quantity))
+    return parsed, None
+
+
+@bp.route('/cart/batch', methods=['POST'])
+def cart_batch():
+    if 'user_id' not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    operations, error = parse_cart_operations(request.get_json(silent=True))
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Reject the whole batch if it names a product that does not exist
+    product_ids = {product_id for _, product_id, _ in operations}
+    found = set(db.session.scalars(
+        db.select(Product.id).where(Product.id.in_(product_ids))))
+    missing = sorted(product_ids - found)
+    if missing:
+        return jsonify({"error": "Unknown products",
+                        "product_ids": missing}), 404
+
+    user_id = session['user_id']
+    try:
+        # All operations are applied in order, in a single transaction
+        for action, product_id, quantity in operations:
+            if action == 'remove' or (action == 'update' and quantity < 1):
+                Cart.query.filter_by(
+                    user_id=user_id, product_id=product_id).delete()
+            else:
+                cart_upsert(user_id, product_id, quantity,
+                            increment=action == 'add')
+        summary = get_cart_summary(user_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
 
+    invalidate_cart_count()
+    return jsonify(summary), 200
 
-@app.route('/checkout')
+
+@bp.route('/checkout')
 def checkout():
     if 'user_id' not in session:
         flash("Please log in to checkout.", "error")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
 
     user_id = session['user_id']
     cart_items = db.session.query(
@@ -416,46 +1895,230 @@ def checkout():
     return render_template('checkout.html', cart_items=cart_items)
 
 
-@app.route('/confirm_purchase', methods=['POST'])
+def sales_columns(model, statement):
+    """ON CONFLICT updates adding the new figures to a rollup row."""
+    return {name: getattr(model, name) + getattr(statement.excluded, name)
+            for name in ('orders', 'units', 'revenue')}
+
+
+def record_sales(purchase_event_id, day):
+    """Add an order's items to the sales rollups.
+
+    Runs in the caller's transaction.
+    """
+    insert = upsert_insert()
+    revenue = Purchase.quantity * db.func.coalesce(Purchase.unit_price, 0)
+    items = db.select().select_from(Purchase).where(
+        Purchase.purchase_event_id == purchase_event_id)
+
+    statement = insert(DailySales).from_select(
+        ['day', 'orders', 'units', 'revenue'],
+        items.add_columns(db.literal(day, db.Date), db.literal(1),
+                          db.func.sum(Purchase.quantity),
+                          db.func.sum(revenue)))
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['day'], set_=sales_columns(DailySales, statement)))
+
+    # A product is in an order at most once, as it was in the cart
+    statement = insert(ProductSales).from_select(
+        ['day', 'product_id', 'orders', 'units', 'revenue'],
+        items.add_columns(db.literal(day, db.Date), Purchase.product_id,
+                          db.literal(1), Purchase.quantity, revenue))
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['day', 'product_id'],
+        set_=sales_columns(ProductSales, statement)))
+
+
+def remove_sales(purchase_event_ids):
+    """Take orders out of the sales rollups, in the caller's transaction.
+
+    Rows left without orders are dropped.
+    """
+    day = db.func.date(PurchaseEvent.purchase_date)
+    revenue = Purchase.quantity * db.func.coalesce(Purchase.unit_price, 0)
+    items = db.select().select_from(PurchaseEvent).join(
+        Purchase, Purchase.purchase_event_id == PurchaseEvent.id).where(
+        PurchaseEvent.id.in_(purchase_event_ids))
+    figures = {'orders': db.func.count(db.distinct(PurchaseEvent.id)),
+               'units': db.func.sum(Purchase.quantity),
+               'revenue': db.func.sum(revenue)}
+
+    for model, keys, key_columns in (
+            (DailySales, [day], [DailySales.day]),
+            (ProductSales, [day, Purchase.product_id],
+             [ProductSales.day, ProductSales.product_id])):
+        # Each figure is the orders' share of the row being updated
+        share = items.where(*(key == column for key, column
+                              in zip(keys, key_columns)))
+        db.session.execute(db.update(model).where(
+            db.tuple_(*key_columns).in_(items.add_columns(*keys))
+        ).values({name: getattr(model, name) - share.add_columns(
+            db.func.coalesce(figure, 0)).scalar_subquery()
+            for name, figure in figures.items()}))
+        db.session.execute(db.delete(model).where(model.orders <= 0))
+
+
+def rebuild_sales_rollups():
+    """Recompute the sales rollups from the full purchase history."""
+    day = db.func.date(PurchaseEvent.purchase_date)
+    revenue = Purchase.quantity * db.func.coalesce(Purchase.unit_price, 0)
+    items = db.select().select_from(PurchaseEvent).join(
+        Purchase, Purchase.purchase_event_id == PurchaseEvent.id)
+
+    db.session.execute(db.delete(DailySales))
+    db.session.execute(db.delete(ProductSales))
+    db.session.execute(db.insert(DailySales).from_select(
+        ['day', 'orders', 'units', 'revenue'],
+        items.add_columns(
+            day, db.func.count(db.distinct(PurchaseEvent.id)),
+            db.func.sum(Purchase.quantity), db.func.sum(revenue)
+        ).group_by(day)))
+    db.session.execute(db.insert(ProductSales).from_select(
+        ['day', 'product_id', 'orders', 'units', 'revenue'],
+        items.add_columns(
+            day, Purchase.product_id,
+            db.func.count(db.distinct(PurchaseEvent.id)),
+            db.func.sum(Purchase.quantity), db.func.sum(revenue)
+        ).group_by(day, Purchase.product_id)))
+    db.session.commit()
+
+
+def sales_summary(from_date, to_date, top=None):
+    """Sales between two dates (the end exclusive) from the rollups.
+
+    Returns the totals, the figures for each day with sales, and the
+    ``top`` best-selling products by units.
+    """
+    days = DailySales.query.filter(
+        DailySales.day >= from_date, DailySales.day < to_date
+    ).order_by(DailySales.day).all()
+
+    units = db.func.sum(ProductSales.units)
+    top_products = db.session.query(
+        ProductSales.product_id, Product.name, units,
+        db.func.sum(ProductSales.revenue)
+    ).outerjoin(Product, ProductSales.product_id == Product.id).filter(
+        ProductSales.day >= from_date, ProductSales.day < to_date
+    ).group_by(ProductSales.product_id, Product.name).order_by(
+        units.desc(), ProductSales.product_id).limit(
+        top or current_app.config['ADMIN_TOP_PRODUCTS']).all()
+
+    return {
+        "from_date": from_date.isoformat(),
+        "to_date": (to_date - timedelta(days=1)).isoformat(),
+        "orders": sum(day.orders for day in days),
+        "units": sum(day.units for day in days),
+        "revenue": round(sum(day.revenue for day in days), 2),
+        "days": [{"day": day.day.isoformat(), "orders": day.orders,
+                  "units": day.units, "revenue": round(day.revenue, 2)}
+                 for day in days],
+        "top_products": [{"product_id": product_id,
+                          "name": name or 'Deleted product',
+                          "units": product_units,
+                          "revenue": round(revenue, 2)}
+                         for product_id, name, product_units, revenue
+                         in top_products],
+    }
+
+
+def parse_date_range(from_text, to_text):
+    """Parse inclusive YYYY-MM-DD dates into a [from, to) datetime range.
+
+    Raises ValueError if either date is malformed.
+    """
+    from_date = datetime.strptime(from_text, '%Y-%m-%d')
+    to_date = datetime.strptime(to_text, '%Y-%m-%d') + timedelta(days=1)
+    return from_date, to_date
+
+
+def find_purchase_event_id(user_id, idempotency_key):
+    return db.session.scalar(db.select(PurchaseEvent.id).where(
+        PurchaseEvent.user_id == user_id,
+        PurchaseEvent.idempotency_key == idempotency_key))
+
+
+@bp.route('/confirm_purchase', methods=['POST'])
 def confirm_purchase():
     if 'user_id' not in session:
         return jsonify({"error": "User not logged in"}), 401
 
     user_id = session['user_id']
-    address_id = request.json.get('address_id')
+    payload = request.get_json(silent=True) or {}
+    address_id = payload.get('address_id')
+    idempotency_key = (request.headers.get('Idempotency-Key')
+                       or payload.get('idempotency_key'))
+    if idempotency_key is not None:
+        idempotency_key = str(idempotency_key)[:64]
+
+        # A retry of an order that already went through
+        purchase_event_id = find_purchase_event_id(user_id, idempotency_key)
+        if purchase_event_id:
+            return jsonify({"status": "success",
+                            "purchase_event_id": purchase_event_id}), 200
+
+    address = db.session.get(Address, address_id) if address_id else None
+    if not address or address.user_id != user_id:
+        return jsonify({"error": "Please select one of your addresses."}), 400
 
     try:
-        # Create a new PurchaseEvent with the selected address
-        purchase_event = PurchaseEvent(user_id=user_id, address_id=address_id)
-        db.session.add(purchase_event)
-        db.session.flush()
-
-        # Fetch all items from the cart for the current user
-        cart_items = Cart.query.filter_by(user_id=user_id).all()
-
-        for cart_item in cart_items:
-            purchase = Purchase(
-                purchase_event_id=purchase_event.id,
-                product_id=cart_item.product_id,
-                quantity=cart_item.quantity
-            )
-            db.session.add(purchase)
+        # The first insert takes the write lock, so nothing can change the
+        # cart between copying it into the order and clearing it
+        purchase_date = datetime.utcnow()
+        purchase_event_id = db.session.execute(
+            db.insert(PurchaseEvent).values(
+                user_id=user_id, address_id=address.id,
+                purchase_date=purchase_date,
+                idempotency_key=idempotency_key)
+        ).inserted_primary_key[0]
+
+        # Copy the whole cart into the order in one statement, at today's
+        # prices
+        copied = db.session.execute(
+            db.insert(Purchase).from_select(
+                ['purchase_event_id', 'product_id', 'quantity', 'unit_price'],
+                db.select(db.literal(purchase_event_id), Cart.product_id,
+                          Cart.quantity, Product.price).join(
+                    Product, Cart.product_id == Product.id).where(
+                    Cart.user_id == user_id))
+        ).rowcount
+        if not copied:
+            db.session.rollback()
+            return jsonify({"error": "Your cart is empty."}), 400
+
+        record_sales(purchase_event_id, purchase_date.date())
 
         # Clear the cart after purchase
-        Cart.query.filter_by(user_id=user_id).delete()
-        
+        db.session.execute(db.delete(Cart).where(Cart.user_id == user_id))
+
         db.session.commit()
+        invalidate_cart_count()
         return jsonify(
-            {"status": "success", "purchase_event_id": purchase_event.id}), 200
+            {"status": "success", "purchase_event_id": purchase_event_id}), 200
+
+    except IntegrityError as e:
+        # A concurrent retry with the same key placed the order first
+        db.session.rollback()
+        purchase_event_id = None
+        if idempotency_key is not None:
+            purchase_event_id = find_purchase_event_id(user_id,
+                                                       idempotency_key)
+        if not purchase_event_id:
+            return jsonify({"error": str(e)}), 500
+        return jsonify({"status": "success",
+                        "purchase_event_id": purchase_event_id}), 200
 
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
     
 
-@app.route('/purchase_details/<int:purchase_event_id>')
+@bp.route('/purchase_details/<int:purchase_event_id>')
+@query_budget(2)
 def purchase_details(purchase_event_id):
-    purchase_event = PurchaseEvent.query.get(purchase_event_id)
+    purchase_event = db.session.get(PurchaseEvent, purchase_event_id, options=[
+        joinedload(PurchaseEvent.address),
+        selectinload(PurchaseEvent.purchases).joinedload(Purchase.product)
+    ])
 
     if not purchase_event:
         return jsonify({"error": "Purchase event not found"}), 404
@@ -475,7 +2138,8 @@ def purchase_details(purchase_event_id):
         "items": [
             {
                 "product_id": item.product_id,
-                "product_name": item.product.name,
+                "product_name": (item.product.name if item.product
+                                 else 'Deleted product'),
                 "quantity": item.quantity
             } for item in purchase_event.purchases
         ]
@@ -484,53 +2148,299 @@ def purchase_details(purchase_event_id):
     return jsonify(response), 200
 
 
-@app.context_processor
+@bp.app_context_processor
 def inject_user_data():
-    cart_count = 0
-    is_admin = False
-    
-    if 'user_id' in session:
-        # Get cart count
-        cart_count = Cart.query.filter_by(user_id=session['user_id']).count()
-        
-        # Check if the user is an admin
-        user = User.query.get(session['user_id'])
-        is_admin = user.is_admin if user else False
+    # Both values are cached for the request, so rendering several
+    # templates (or an admin view that already loaded the user) is free
+    user = get_current_user()
+    is_admin = user.is_admin if user else False
+
+    return {'cart_count': get_cart_count(), 'is_admin': is_admin}
+
 
-    return {'cart_count': cart_count, 'is_admin': is_admin}
+# Content hashes of static files by name, with the mtime they were taken at
+static_fingerprints = {}
 
 
-@app.after_request
+def static_fingerprint(filename):
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = static_fingerprints.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as file:
+        fingerprint = hashlib.sha256(file.read()).hexdigest()[:12]
+    static_fingerprints[filename] = (mtime, fingerprint)
+    return fingerprint
+
+
+@bp.app_url_defaults
+def add_static_fingerprint(endpoint, values):
+    # url_for('static', ...) gets ?v=<content hash>, so a changed file gets
+    # a new URL and the old one can be cached forever
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+
+# Endpoints that set their own Cache-Control instead of the no-store default
+SELF_CACHED_ENDPOINTS = {'main.uploaded_file', 'main.download_report',
+                         'main.api_products', 'main.api_product_detail'}
+
+
+@bp.after_app_request
 def add_cache_control_header(response):
+    if request.endpoint == 'static':
+        filename = request.view_args['filename']
+        version = request.args.get('v')
+        if version and version == static_fingerprint(filename):
+            response.cache_control.public = True
+            response.cache_control.max_age = current_app.config[
+                'IMMUTABLE_MAX_AGE']
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+        return response
+    if request.endpoint in SELF_CACHED_ENDPOINTS:
+        return response
+
+    # Everything else is personalized (flash messages, cart count, login
+    # state) and must never be stored
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
 
+@bp.after_app_request
+def compress_generated_response(response):
+    if not current_app.config['COMPRESSION_ENABLED'] or not is_compressible(
+            response, current_app.config['COMPRESSION_MIN_SIZE']):
+        return response
+    # Caches must keep the compressed and uncompressed bodies apart
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding:
+        compress_response(response, encoding,
+                          current_app.config['COMPRESSION_LEVELS'])
+    return response
+
+
+def static_file(filename):
+    """Serve a static file, precompressed if the client accepts it.
+
+    The copies are written by ``flask precompress-static`` and ignored once
+    the file is newer than them, so nothing is compressed per request.
+    """
+    path = safe_join(current_app.static_folder, filename)
+    copies = {}
+    for encoding in ENCODING_SUFFIXES:
+        copy = path and fresh_precompressed_path(path, encoding)
+        if copy:
+            copies[encoding] = copy
+    encoding = choose_encoding(request.accept_encodings, list(copies))
+    if encoding:
+        response = send_file(
+            copies[encoding], mimetype=mimetypes.guess_type(filename)[0],
+            max_age=current_app.get_send_file_max_age(filename),
+            conditional=True)
+        response.content_encoding = encoding
+    else:
+        response = current_app.send_static_file(filename)
+    if copies:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+@bp.cli.command('precompress-static')
+def precompress_static_command():
+    """Write gzip and brotli copies of the static files; run on deploy."""
+    written = precompress_directory(current_app.static_folder,
+                                    current_app.config['COMPRESSION_MIN_SIZE'])
+    click.echo(f"Wrote {written} compressed files.")
+
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user_id = session.get('user_id')
-        user = User.query.get(user_id)
+        user = get_current_user()
         if not user or not user.is_admin:
             flash("Admin access required.", "error")
-            return redirect(url_for('home'))
+            return redirect(url_for('main.home'))
         return f(*args, **kwargs)
     return decorated_function
 
 
-@app.route('/admin')
+@bp.route('/admin')
+@query_budget(8)
 @admin_required
 def admin():
-    # Query all purchases and reports
-    purchases = Purchase.query.all()
+    # Query the most recent purchases, with their order, buyer and product
+    # loaded in the same statement, and all reports
+    purchases = Purchase.query.join(Purchase.purchase_event).options(
+        joinedload(Purchase.product),
+        contains_eager(Purchase.purchase_event).joinedload(PurchaseEvent.user)
+    ).order_by(PurchaseEvent.purchase_date.desc(), Purchase.id.desc()).limit(
+        current_app.config['ADMIN_RECENT_PURCHASES']).all()
     reports = Report.query.order_by(Report.created_at.desc()).all()
+    jobs = Job.query.order_by(Job.id.desc()).limit(10).all()
+
+    # Recent sales, read from the rollups rather than the purchase history
+    to_date = datetime.utcnow().date() + timedelta(days=1)
+    sales = sales_summary(
+        to_date - timedelta(days=current_app.config['ADMIN_SALES_DAYS']),
+        to_date)
     
-    return render_template('admin.html', purchases=purchases, reports=reports)
+    return render_template('admin.html', purchases=purchases, reports=reports,
+                           jobs=[serialize_job(job) for job in jobs],
+                           sales=sales)
 
 
-@app.route('/generate_report')
+PROFILE_SORT_OPTIONS = {
+    'cumulative': 'Cumulative time',
+    'tottime': 'Own time',
+    'calls': 'Calls',
+}
+
+
+@bp.route('/admin/profiles')
+@admin_required
+def request_profiles():
+    return render_template(
+        'profiles.html', profiles=profile_store.slowest(), selected=None,
+        enabled=bool(current_app.config['PROFILE_SAMPLE_RATE']))
+
+
+@bp.route('/admin/profiles/<name>')
+@admin_required
+def request_profile(name):
+    sort = request.args.get('sort')
+    if sort not in PROFILE_SORT_OPTIONS:
+        sort = 'cumulative'
+    try:
+        if request.args.get('download'):
+            return send_file(os.path.abspath(profile_store.path(name)),
+                             as_attachment=True)
+        selected = profile_store.metadata(name)
+        summary = profile_store.summary(name, sort)
+    except (ValueError, OSError):
+        flash("Profile not found or rotated away.", "error")
+        return redirect(url_for('main.request_profiles'))
+    return render_template(
+        'profiles.html', selected=selected, summary=summary, sort=sort,
+        sort_options=PROFILE_SORT_OPTIONS)
+
+
+@bp.route('/admin/sales')
+@admin_required
+@read_only
+def admin_sales():
+    # Dates are inclusive; the default is the dashboard's window
+    from_text = request.args.get('from_date')
+    to_text = request.args.get('to_date')
+    if from_text and to_text:
+        try:
+            from_date, to_date = parse_date_range(from_text, to_text)
+        except ValueError:
+            return jsonify(
+                {"error": "Invalid date format. Please use YYYY-MM-DD."}), 400
+        from_date, to_date = from_date.date(), to_date.date()
+    else:
+        to_date = datetime.utcnow().date() + timedelta(days=1)
+        from_date = to_date - timedelta(
+            days=current_app.config['ADMIN_SALES_DAYS'])
+    top = request.args.get('top', type=int)
+    return jsonify(sales_summary(from_date, to_date, top)), 200
+
+
+REPORT_HEADER = [
+    'User Email', 'User ID', 'Purchase Event ID', 'Address',
+    'Product Name', 'Quantity', 'Purchase Date'
+]
+
+
+def report_query(from_date, to_date):
+    """Every purchased item in the date range, with its order details."""
+    return db.session.query(
+        User.email, PurchaseEvent.user_id, PurchaseEvent.id,
+        Address.street, Address.city, Address.state, Address.zip_code,
+        Address.country, Product.name, Purchase.quantity,
+        PurchaseEvent.purchase_date
+    ).select_from(PurchaseEvent).join(
+        User, PurchaseEvent.user_id == User.id).join(
+        Address, PurchaseEvent.address_id == Address.id).join(
+        Purchase, Purchase.purchase_event_id == PurchaseEvent.id).outerjoin(
+        Product, Purchase.product_id == Product.id).filter(
+        PurchaseEvent.purchase_date >= from_date,
+        PurchaseEvent.purchase_date < to_date
+    ).order_by(PurchaseEvent.purchase_date, PurchaseEvent.id, Purchase.id)
+
+
+def iter_report_rows(from_date, to_date):
+    """Yield one CSV row per purchased item in the given date range.
+
+    Everything comes from a single joined query that is streamed in batches
+    of REPORT_BATCH_SIZE rows, so memory use does not depend on the range.
+    """
+    query = report_query(from_date, to_date).yield_per(
+        current_app.config['REPORT_BATCH_SIZE'])
+
+    for (email, user_id, event_id, street, city, state, zip_code, country,
+         product_name, quantity, purchase_date) in query:
+        yield [
+            email,
+            user_id,
+            event_id,
+            f"{street}, {city}, {state}, {zip_code}, {country}",
+            product_name or '',  # The product may have been deleted since
+            quantity,
+            purchase_date.strftime('%Y-%m-%d %H:%M:%S')
+        ]
+
+
+def count_report_rows(from_date, to_date):
+    return db.session.query(db.func.count(Purchase.id)).join(
+        PurchaseEvent, Purchase.purchase_event_id == PurchaseEvent.id).filter(
+        PurchaseEvent.purchase_date >= from_date,
+        PurchaseEvent.purchase_date < to_date).scalar()
+
+
+def write_report_csv(csvfile, from_date, to_date, progress=None):
+    """Write the report to an open file.
+
+    ``progress`` is called with the number of rows written after each batch.
+    """
+    writer = csv.writer(csvfile)
+    writer.writerow(REPORT_HEADER)
+    if not from_date:
+        return
+    batch_size = current_app.config['REPORT_BATCH_SIZE']
+    for count, row in enumerate(iter_report_rows(from_date, to_date),
+                                start=1):
+        writer.writerow(row)
+        if progress and count % batch_size == 0:
+            progress(count)
+
+
+def stream_report_csv(from_date, to_date):
+    """Yield the report as CSV text, a batch of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REPORT_HEADER)
+    rows = iter_report_rows(from_date, to_date) if from_date else []
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % current_app.config['REPORT_BATCH_SIZE'] == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@bp.route('/generate_report')
 @admin_required
 def generate_report():
     # Retrieve query parameters
@@ -540,145 +2450,251 @@ def generate_report():
     # Validate date inputs
     if from_date and to_date:
         try:
-            from_date = datetime.strptime(from_date, '%Y-%m-%d')
-            to_date = datetime.strptime(
-                to_date, '%Y-%m-%d') + timedelta(days=1)  
+            from_date, to_date = parse_date_range(from_date, to_date)
         except ValueError:
             flash("Invalid date format. Please use YYYY-MM-DD.", "danger")
-            return redirect(url_for('admin'))
-
-        # Fetch purchase events within the specified date range
-        purchase_events = PurchaseEvent.query.filter(
-            PurchaseEvent.purchase_date >= from_date,
-            PurchaseEvent.purchase_date < to_date
-        ).all()
+            return redirect(url_for('main.admin'))
     else:
-        purchase_events = []  # Handle case where dates are not provided
-
-    # Generate a unique filename with a timestamp
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    file_path = f'reports/user_purchases_report_{timestamp}.csv'
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-    # Create and write data to CSV file
-    with open(file_path, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        
-        # Write headers for the CSV file
-        writer.writerow([
-            'User Email', 'User ID', 'Purchase Event ID', 'Address', 
-            'Product Name', 'Quantity', 'Purchase Date'
-        ])
+        from_date = to_date = None  # Produces an empty report
+
+    # Download mode streams the CSV straight to the browser without saving it
+    if request.args.get('download'):
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        filename = f'user_purchases_report_{timestamp}.csv'
+        return Response(
+            stream_with_context(stream_report_csv(from_date, to_date)),
+            mimetype='text/csv',
+            headers={'Content-Disposition':
+                     f'attachment; filename={filename}'})
+
+    # The rollups tell us up front whether there is anything to report
+    if from_date:
+        sales = sales_summary(from_date.date(), to_date.date())
+        if not sales['orders']:
+            flash("No purchases were made between those dates.", "danger")
+            return redirect(url_for('main.admin'))
+
+    # Write the report file in the background and let the dashboard poll it
+    enqueue_job(
+        'generate_report',
+        from_date=from_date.isoformat() if from_date else None,
+        to_date=to_date.isoformat() if to_date else None)
 
-        # Write data grouped by purchase events
-        for event in purchase_events:
-            # Get user and address details for each purchase event
-            user_email = event.user.email
-            address = f"{event.address.street}, {event.address.city}, \
-                {event.address.state}, {event.address.zip_code}, \
-                    {event.address.country}"
-            purchase_date = event.purchase_date.strftime('%Y-%m-%d %H:%M:%S')
-
-            # Write each item in the purchase event
-            for purchase in event.purchases:
-                writer.writerow([
-                    user_email,
-                    event.user_id,
-                    event.id,
-                    address,
-                    purchase.product.name,
-                    purchase.quantity,
-                    purchase_date
-                ])
-
-    # Save report path to the database
+    # Notify admin and redirect
+    if from_date:
+        flash(f"Report generation started for {sales['orders']} orders "
+              f"(₹{sales['revenue']}).", "success")
+    else:
+        flash("Report generation started.", "success")
+    return redirect(url_for('main.admin'))
+
+
+@job_handler('generate_report')
+def generate_report_job(job):
+    from_date = job.params['from_date']
+    to_date = job.params['to_date']
+    if from_date:
+        from_date = datetime.fromisoformat(from_date)
+        to_date = datetime.fromisoformat(to_date)
+        total = count_report_rows(from_date, to_date)
+    else:
+        total = 0
+
+    # Generate a unique storage key from the time and the job, sharded by
+    # month
+    now = datetime.now()
+    file_path = (f"{now:%Y/%m}/user_purchases_report_"
+                 f"{now:%Y%m%d%H%M%S}_{job.job_id}.csv")
+
+    # Stream the CSV into storage, with compressed copies for downloads
+    # written alongside; nothing is kept if the job is cancelled
+    with ExitStack() as stack:
+        file = stack.enter_context(report_storage.open_write(file_path))
+        copies = {encoding: stack.enter_context(report_storage.open_write(
+            precompressed_path(file_path, encoding)))
+            for encoding in available_encodings()}
+        writer = CompressingWriter(file, copies)
+        csvfile = io.TextIOWrapper(writer, encoding='utf-8', newline='')
+        write_report_csv(
+            csvfile, from_date, to_date,
+            progress=lambda count: job.progress(
+                count, total, f"Wrote {count} of {total} rows."))
+        csvfile.flush()
+        csvfile.detach()
+        writer.finish()
+
+    # Save the report's storage key to the database
     report = Report(file_path=file_path)
     db.session.add(report)
     db.session.commit()
-
-    # Notify admin and redirect
-    flash("Report generated successfully!", "success")
-    return redirect(url_for('admin'))
+    return "Report generated successfully!"
 
 
-@app.route('/view_report/<int:report_id>')
+@bp.route('/view_report/<int:report_id>')
+@read_only
 @admin_required
 def view_report(report_id):
-    report = Report.query.get(report_id)
-    if report and os.path.exists(report.file_path):
-        # Use csv.reader to handle quoted fields correctly
-        with open(report.file_path, 'r') as file:
-            reader = csv.reader(file)
-            content = [row for row in reader]  # Each row is a list of values
+    report = db.session.get(Report, report_id)
+    path = report and fetch_report_file(report)
+    if path:
+        # Only the requested page is read, through the report's row index
+        index = ReportIndex(path)
+        per_page = max(1, min(request.args.get(
+            'per_page', current_app.config['REPORT_PAGE_SIZE'], type=int),
+            current_app.config['REPORT_MAX_PAGE_SIZE']))
+        page = max(1, request.args.get('page', 1, type=int))
+
+        sort_column = request.args.get('sort', type=int)
+        if sort_column is not None and not 0 <= sort_column < len(
+                index.header):
+            sort_column = None
+        filter_column = request.args.get('column', type=int)
+        if filter_column is not None and not 0 <= filter_column < len(
+                index.header):
+            filter_column = None
+        options = {
+            'sort': sort_column,
+            'order': 'desc' if request.args.get('order') == 'desc' else 'asc',
+            'column': filter_column,
+            'q': request.args.get('q', '').strip()
+        }
 
-        return render_template('view_report.html', report_content=content)
+        rows, has_next = index.page(
+            (page - 1) * per_page, per_page, sort_column=sort_column,
+            descending=options['order'] == 'desc',
+            filter_column=filter_column, filter_text=options['q'])
+
+        return render_template(
+            'view_report.html', report=report, header=index.header,
+            rows=rows, total_rows=index.row_count, page=page,
+            per_page=per_page, has_next=has_next,
+            options={key: value for key, value in options.items()
+                     if value not in (None, '')})
     else:
         flash("Report not found or deleted.", "error")
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
 
 
-@app.route('/download_report/<int:report_id>')
+@bp.route('/download_report/<int:report_id>')
 @admin_required
 def download_report(report_id):
     # Retrieve the report by ID
     report = Report.query.get(report_id)
-    if report and os.path.exists(report.file_path):
-        return send_file(report.file_path, as_attachment=True)
+    if report and report_storage.exists(report.file_path):
+        encoding = choose_report_copy(report.file_path)
+        key = report.file_path
+        if encoding:
+            key = precompressed_path(key, encoding)
+        # Conditional and range requests are answered by the storage
+        response = report_storage.serve(
+            key, download_name=posixpath.basename(report.file_path),
+            content_type='text/csv', content_encoding=encoding)
+        response.cache_control.private = True
+        response.vary.add('Accept-Encoding')
+        return response
     else:
         flash("Report not found or deleted.", "error")
-        return redirect(url_for('admin'))
+        return redirect(url_for('main.admin'))
+
+
+def choose_report_copy(file_path):
+    """Return the encoding of the compressed copy to send, if any.
+
+    The copies are written with the report; older reports have none.
+    """
+    encodings = list(ENCODING_SUFFIXES)
+    while True:
+        encoding = choose_encoding(request.accept_encodings, encodings)
+        if encoding is None or report_storage.exists(
+                precompressed_path(file_path, encoding)):
+            return encoding
+        encodings.remove(encoding)
+
+
+def fetch_report_file(report):
+    """Return a local path to the report's CSV, or None if it is gone."""
+    try:
+        return report_storage.fetch(report.file_path)
+    except (FileNotFoundError, ValueError):
+        return None
 
 
-@app.route('/delete_all_reports', methods=['POST'])
+def delete_report_file(file_path):
+    """Delete a report's CSV, its compressed copies and local indexes."""
+    remove_index_files(report_storage.local_path(file_path))
+    report_storage.delete(file_path)
+    for encoding in ENCODING_SUFFIXES:
+        report_storage.delete(precompressed_path(file_path, encoding))
+
+
+@bp.route('/delete_all_reports', methods=['POST'])
 @admin_required
 def delete_all_reports():
-    # Retrieve all reports
-    reports = Report.query.all()
-    
-    # Loop through reports and delete each one
-    for report in reports:
-        if os.path.exists(report.file_path):  # Check if the file exists
-            os.remove(report.file_path)  # Delete the file
-        db.session.delete(report)  # Delete the report from the database
-    
-    db.session.commit()  # Commit the changes to the database
-    
-    flash("All reports have been successfully deleted.", "success")
-    return redirect(url_for('admin'))
+    enqueue_job('delete_all_reports')
+    flash("Deleting all reports.", "success")
+    return redirect(url_for('main.admin'))
 
 
-@app.route('/delete_report/<int:report_id>', methods=['POST'])
+@job_handler('delete_all_reports')
+def delete_all_reports_job(job):
+    def delete_files(report_ids):
+        # The files go first: a report without its file already shows as
+        # deleted, while a file without its report would never be removed
+        file_paths = db.session.scalars(db.select(Report.file_path).where(
+            Report.id.in_(report_ids))).all()
+        db.session.commit()  # Keep no transaction open while storage works
+        for file_path in file_paths:
+            delete_report_file(file_path)
+
+    num_deleted = purge_rows(job, Report, 'reports', delete_files)
+    return f"Successfully deleted {num_deleted} reports and their files."
+
+
+@bp.route('/delete_report/<int:report_id>', methods=['POST'])
 @admin_required
 def delete_report(report_id):
     report = Report.query.get(report_id)
     if report:
-        file_path = report.file_path
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
+        delete_report_file(report.file_path)
         db.session.delete(report)
         db.session.commit()
         flash("Report and file deleted successfully.", "success")
     else:
         flash("Report not found.", "error")
-    return redirect(url_for('admin'))
+    return redirect(url_for('main.admin'))
+
 
+@lru_cache(maxsize=None)
+def get_faker():
+    # Faker is slow to import and only needed for sample data
+    from faker import Faker
+    return Faker()
 
-fake = Faker()
 
+SAMPLE_IMAGES = ["sample1.jpg", "sample2.jpg", "sample3.jpg", "sample4.jpg"]
 
-@app.route('/add_sample_products', methods=['POST'])
+
+@bp.route('/add_sample_products', methods=['POST'])
 @admin_required
 def add_sample_products():
+    # The products are attached to the logged-in admin
+    enqueue_job('add_sample_products', user_id=session['user_id'])
+    flash("Adding sample products.", "success")
+    return redirect(url_for('main.admin'))
+
+
+@job_handler('add_sample_products')
+def add_sample_products_job(job):
     # Generate a random number of products between 3 and 8
     num_products = random.randint(3, 8)
-    sample_conditions = ["New", "Like New", "Used"]
-    sample_images = [
-        "sample1.jpg", "sample2.jpg", "sample3.jpg", "sample4.jpg"] 
+    sample_conditions = PRODUCT_CONDITIONS
+    sample_images = SAMPLE_IMAGES
 
-    # Get the logged-in user's ID
-    user_id = session['user_id']
+    # Get the ID of the admin who started the job
+    user_id = job.params['user_id']
 
     new_products = []
+    fake = get_faker()
     
     for _ in range(num_products):
         product = Product(
@@ -692,52 +2708,100 @@ def add_sample_products():
         db.session.add(product)
         new_products.append(product)
 
-    # Commit all new products to the database
+    # Commit all new products to the database, along with their search entries
+    db.session.flush()
+    index_products([product.id for product in new_products])
+    bump_catalog_version()
     db.session.commit()
 
-    flash(f"Successfully added {num_products} sample products.", "success")
-    return redirect(url_for('admin'))
+    return f"Successfully added {num_products} sample products."
 
 
-@app.route('/delete_all_products', methods=['POST'])
+@bp.route('/delete_all_products', methods=['POST'])
 @admin_required
 def delete_all_products():
-    product_ids = [product.id for product in Product.query.all()]
-    # Delete all entries from the Product table
-    num_deleted = Product.query.delete()
-    # Delete corresponding cart items with those product IDs
-    Cart.query.filter(Cart.product_id.in_(product_ids)).delete(
-        synchronize_session=False)
-    # Commit changes to the database
-    db.session.commit()
-    flash(f"Successfully deleted {num_deleted} \
-          products and corresponding cart entries from the database.", 
-          "success")
-    return redirect(url_for('admin'))
+    enqueue_job('delete_all_products')
+    invalidate_cart_count()
+    flash("Deleting all products.", "success")
+    return redirect(url_for('main.admin'))
+
+
+@job_handler('delete_all_products')
+def delete_all_products_job(job):
+    def delete_dependents(product_ids):
+        # Carts lose the products; orders keep them as deleted products,
+        # like the sales rollups and reports do
+        Cart.query.filter(Cart.product_id.in_(product_ids)).delete(
+            synchronize_session=False)
+        unindex_products(product_ids)
+        # Cached pages must not list products that are gone
+        bump_catalog_version()
+
+    num_deleted = purge_rows(job, Product, 'products', delete_dependents)
+    return (f"Successfully deleted {num_deleted} products and "
+            "corresponding cart entries from the database.")
     
 
-@app.route('/delete_all_purchases', methods=['POST'])
+@bp.route('/delete_all_purchases', methods=['POST'])
 @admin_required
 def delete_all_purchases():
-    # Delete all entries from the Purchase and PurchaseEvent tables
-    num_deleted_purchases = Purchase.query.delete()
-    num_deleted_events = PurchaseEvent.query.delete()
-    # Commit changes to the database
-    db.session.commit()
-    flash(f"Successfully deleted {num_deleted_purchases} \
-            purchase entries and {num_deleted_events} purchase event entries\
-            from the database.", "success")
-    return redirect(url_for('admin'))
+    enqueue_job('delete_all_purchases')
+    flash("Deleting all purchases.", "success")
+    return redirect(url_for('main.admin'))
+
+
+@job_handler('delete_all_purchases')
+def delete_all_purchases_job(job):
+    num_deleted_purchases = 0
 
+    def delete_dependents(purchase_event_ids):
+        nonlocal num_deleted_purchases
+        # The sales rollups summarise the purchases, so they shrink with them
+        remove_sales(purchase_event_ids)
+        num_deleted_purchases += Purchase.query.filter(
+            Purchase.purchase_event_id.in_(purchase_event_ids)).delete(
+            synchronize_session=False)
 
-@app.route('/toggle_admin')
+    num_deleted_events = purge_rows(job, PurchaseEvent, 'orders',
+                                    delete_dependents)
+    return (f"Successfully deleted {num_deleted_purchases} purchase entries "
+            f"and {num_deleted_events} purchase event entries from the "
+            "database.")
+
+
+@bp.route('/jobs/<int:job_id>')
+@admin_required
+def job_status(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job_abandoned(job):
+        finish_job(job_id, 'failed', 'Its server process stopped running.')
+    return jsonify(serialize_job(job)), 200
+
+
+@bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@admin_required
+def cancel_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job_abandoned(job):
+        # No process is left to notice the request, so cancel it here
+        finish_job(job_id, 'cancelled', 'Cancelled.')
+    elif job.status in JOB_ACTIVE_STATUSES:
+        job.cancel_requested = True
+        db.session.commit()
+    return jsonify(serialize_job(job)), 200
+
+
+@bp.route('/toggle_admin')
 def toggle_admin():
     if 'user_id' not in session:
         flash("You need to be logged in to toggle admin status.", "error")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     
-    user_id = session['user_id']
-    user = User.query.get(user_id)
+    user = get_current_user()
     
     if user:
         # Toggle the admin status
@@ -748,14 +2812,14 @@ def toggle_admin():
     else:
         flash("User not found.", "error")
     
-    return redirect(request.referrer or url_for('home'))
+    return redirect(request.referrer or url_for('main.home'))
 
 
-@app.route('/add_sample_address')
+@bp.route('/add_sample_address')
 def add_sample_address():
     if 'user_id' not in session:
         flash("Please log in to manage your addresses.", "error")
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     sample_address = Address(
         user_id=1,
         street="123 Maple Street",
@@ -772,8 +2836,247 @@ def add_sample_address():
     db.session.commit()
 
     flash("Sample address added successfully!", "success")
-    return redirect(request.referrer or url_for('home'))
+    return redirect(request.referrer or url_for('main.home'))
+
+
+def hot_path_queries():
+    """Lookups on hot paths, which must all be served by an index."""
+    day = datetime(2024, 1, 1)
+    queries = {
+        'cart item (add_to_cart, updateitem)': Cart.query.filter_by(
+            user_id=1, product_id=1),
+        'cart contents (cart, inject_user_data)': Cart.query.filter_by(
+            user_id=1),
+        'addresses (profile, cart)': Address.query.filter_by(user_id=1),
+        'order history (profile)': PurchaseEvent.query.filter_by(user_id=1),
+        'order items (profile, purchase_details)': Purchase.query.filter_by(
+            purchase_event_id=1),
+        'date range (generate_report)': report_query(
+            day, day + timedelta(days=1)),
+    }
+    # Catalog pages (shop, api_products): a later page, and the first pages
+    # for the filters that have an index. A minimum rating alone matches
+    # many products, so SQLite rightly walks the ids newest first and stops
+    # after a page; it is checked with a cursor.
+    catalog_pages = {
+        'catalog page': ({}, 1),
+        'catalog page by condition': ({'condition': 'New'}, None),
+        'catalog page by price': ({'min_price': 1, 'max_price': 2}, None),
+        'catalog page by rating': ({'min_rating': 4}, 1),
+    }
+    for name, (filters, after_id) in catalog_pages.items():
+        query = apply_catalog_filters(Product.query, filters)
+        if after_id is not None:
+            query = query.filter(Product.id < after_id)
+        queries[f'{name} (shop, api_products)'] = query.order_by(
+            Product.id.desc()).limit(current_app.config['SHOP_PAGE_SIZE'])
+    return queries
+
+
+def find_table_scans():
+    """Return the hot-path queries whose SQLite plan scans a whole table."""
+    connection = db.session.connection()
+    scans = {}
+    for name, query in hot_path_queries().items():
+        compiled = query.statement.compile(dialect=connection.dialect)
+        parameters = tuple(compiled.params[key]
+                           for key in compiled.positiontup)
+        plan = connection.exec_driver_sql(
+            f"EXPLAIN QUERY PLAN {compiled}", parameters).all()
+        details = [row[-1] for row in plan if row[-1].startswith('SCAN ')]
+        if details:
+            scans[name] = details
+    return scans
+
+
+@bp.cli.command('rebuild-sales')
+def rebuild_sales_command():
+    """Recompute the sales rollups from the purchase history."""
+    rebuild_sales_rollups()
+    days = DailySales.query.count()
+    click.echo(f"Rebuilt sales rollups for {days} days.")
+
+
+@bp.cli.command('generate-data')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--products', default=5000, show_default=True)
+@click.option('--orders', default=10000, show_default=True)
+@click.option('--addresses-per-user', default=1, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--cart-items', default=2, show_default=True,
+              help="Products in every generated user's cart.")
+@click.option('--max-order-items', default=3, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--days', default=365, show_default=True,
+              type=click.IntRange(min=1),
+              help="Orders are spread over this many days.")
+@click.option('--end-date', type=click.DateTime(formats=['%Y-%m-%d']),
+              help="Last day of orders (default: today).")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--batch-size', default=5000, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--password', default='password', show_default=True,
+              help="Password of every generated user.")
+def generate_data_command(users, products, orders, addresses_per_user,
+                          cart_items, max_order_items, days, end_date, seed,
+                          batch_size, workers, password):
+    """Add deterministic synthetic users, products and orders."""
+    import synthetic_data  # Imports Faker, so only loaded when needed
+
+    if not users and (products or orders):
+        raise click.ClickException("Products and orders need --users.")
+    if orders and not products:
+        raise click.ClickException("Orders need --products.")
+
+    # New rows continue after the existing ones, so ids are known up front.
+    # Product ids also skip those of deleted products still in orders.
+    def next_id(*columns):
+        return max(db.session.scalar(db.select(db.func.max(column))) or 0
+                   for column in columns) + 1
+
+    first_ids = {
+        'user': next_id(User.id),
+        'address': next_id(Address.id),
+        'product': next_id(Product.id, Purchase.product_id,
+                           ProductSales.product_id),
+        'purchase_event': next_id(PurchaseEvent.id),
+    }
+    if end_date is None:
+        end_date = datetime.combine(datetime.utcnow().date(),
+                                    datetime.min.time())
+    end_date += timedelta(days=1)
+
+    plan = synthetic_data.make_plan(
+        seed, users, products, orders, addresses_per_user, cart_items,
+        max_order_items, end_date, days, first_ids,
+        # Hashed once; bcrypt per user would take longer than everything else
+        hash_password(password), PRODUCT_CONDITIONS, SAMPLE_IMAGES)
+
+    tables = db.metadata.tables
+    started = time.perf_counter()
+    chunks = len(synthetic_data.plan_chunks(plan, batch_size))
+    with click.progressbar(
+            synthetic_data.generate(plan, batch_size, workers),
+            length=chunks, label="Generating data") as generated:
+        for rows in generated:
+            # Core executemany inserts, one transaction per chunk
+            with db.engine.begin() as connection:
+                for table, table_rows in rows.items():
+                    if table_rows:
+                        connection.execute(tables[table].insert(), table_rows)
+
+    # Orders cost what their products did when they were generated
+    db.session.execute(db.update(Purchase).where(
+        Purchase.unit_price.is_(None)).values(
+        unit_price=db.select(Product.price).where(
+            Product.id == Purchase.product_id).scalar_subquery()))
+
+    # Derived data is rebuilt once rather than maintained row by row
+    rebuild_search_index()
+    bump_catalog_version()
+    db.session.commit()
+    rebuild_sales_rollups()
+
+    click.echo(f"Added {users} users, {products} products and {orders} "
+               f"orders in {time.perf_counter() - started:.1f}s.")
+
+
+@bp.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot-path query falls back to a full table scan."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException("Query plans can only be checked on "
+                                   "SQLite.")
+    scans = find_table_scans()
+    for name, details in scans.items():
+        click.echo(f"{name}: {'; '.join(details)}")
+    if scans:
+        raise click.ClickException(
+            f"{len(scans)} hot-path queries scan a whole table.")
+    click.echo("All hot-path queries use an index.")
+
+
+def create_app(config=None):
+    """Build the application and its per-process resources.
+
+    Settings are the defaults above, overridden by FLASK_* environment
+    variables (e.g. FLASK_BCRYPT_LOG_ROUNDS=10) and then by ``config``.
+    ``flask --app app`` calls this itself; WSGI servers and vercel.json load
+    the app made in wsgi.py. Nothing here touches the database or imports
+    optional libraries: the schema is created and upgraded by
+    ``flask upgrade-db``.
+    """
+    app = Flask(__name__)
+    app.config.update(copy.deepcopy(DEFAULT_CONFIG))
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+
+    database_url = app.config['SQLALCHEMY_DATABASE_URI']
+    read_bind = app.config['SQLALCHEMY_BINDS']['read']
+    read_bind.setdefault('url', database_url)
+    if is_memory_database(database_url):
+        # Another engine would open a separate, empty in-memory database
+        app.config['USE_READ_ENGINE'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **pool_options(database_url, app.config['DB_POOL_OPTIONS']),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
+    for name, value in pool_options(
+            read_bind['url'], app.config['READ_DB_POOL_OPTIONS']).items():
+        read_bind.setdefault(name, value)
+
+    db.init_app(app)
+    with app.app_context():
+        for bind_key, engine in db.engines.items():
+            if engine.dialect.name != 'sqlite':
+                continue
+            event.listen(engine, 'connect', set_sqlite_pragmas)
+            if bind_key == 'read':
+                event.listen(engine, 'connect', set_query_only)
+    bcrypt.init_app(app)
+
+    app.register_blueprint(bp)
+    app.view_functions['static'] = static_file
+    before_render_template.connect(start_template_timer, app)
+    template_rendered.connect(stop_template_timer, app)
+
+    if app.config['TEMPLATE_CACHE_DIR']:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+
+    app.extensions['thrift_and_thrive'] = {
+        'upload_storage': make_storage(app.config, 'uploads',
+                                       app.config['UPLOAD_FOLDER']),
+        'report_storage': make_storage(app.config, 'reports',
+                                       app.config['REPORT_FOLDER']),
+        'image_pipeline': ImagePipeline(app.config['IMAGE_WORKERS'],
+                                        app.logger),
+        'password_executor': ThreadPoolExecutor(
+            max_workers=app.config['PASSWORD_HASH_WORKERS'],
+            thread_name_prefix='bcrypt'),
+        'password_slots': threading.BoundedSemaphore(
+            app.config['PASSWORD_HASH_MAX_PENDING']),
+        'fragment_cache': make_fragment_cache(
+            app.config['FRAGMENT_CACHE_SIZE'],
+            app.config['FRAGMENT_CACHE_PATH']),
+        'profile_store': ProfileStore(
+            os.path.join(app.root_path, app.config['PROFILE_DIR']),
+            app.config['PROFILE_MAX_FILES']),
+        # Started by the first job, see get_job_executor()
+        'job_executor': None,
+        'owned_jobs': set(),
+    }
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app = create_app()
+    # The development server sets up the schema itself; deployments run
+    # `flask upgrade-db` instead
+    with app.app_context():
+        setup_database()
+        fail_interrupted_jobs()
+    app.run(debug=True)
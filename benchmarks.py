@@ -0,0 +1,372 @@
+"""Route benchmarks against seeded databases of increasing size.
+
+Run with ``python benchmarks.py``. A scratch database is filled by
+``flask generate-data`` to each scale in turn, and every route is requested
+through the Flask test client. For each route and scale this records the
+p50 and p99 latency, the number of SQL statements per request and the peak
+memory allocated while handling one request.
+
+Cold starts are measured too: fresh interpreters import the app and answer
+a first request against the scratch database, as a new serverless instance
+or worker process would. They are reported under the ``startup`` scale.
+
+Results fail when they exceed the budgets in BUDGETS or, given a baseline
+saved earlier with ``--save-baseline``, when they are worse than it by more
+than the tolerance. A view exceeding its own @query_budget fails the run
+with the logged reason. Budgets on query counts do not depend on the scale: a
+route whose statement count grows with the data has an N+1 problem.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import click
+from sqlalchemy import event
+
+# Rows generated at scale 1; larger scales multiply every count
+BASE_DATASET = {'users': 200, 'products': 1000, 'orders': 2000}
+
+# Upper limits per route: statements per request, p99 latency in
+# milliseconds and peak memory in KiB
+BUDGETS = {
+    'shop': {'queries': 4, 'p99_ms': 150, 'peak_kib': 1024},
+    'shop_next_page': {'queries': 4, 'p99_ms': 150, 'peak_kib': 1024},
+    'search': {'queries': 3, 'p99_ms': 150, 'peak_kib': 1024},
+    'cart': {'queries': 5, 'p99_ms': 100, 'peak_kib': 1024},
+    'profile': {'queries': 6, 'p99_ms': 150, 'peak_kib': 2048},
+    'purchase_details': {'queries': 2, 'p99_ms': 50, 'peak_kib': 512},
+    'confirm_purchase': {'queries': 10, 'p99_ms': 100, 'peak_kib': 512},
+    'admin': {'queries': 8, 'p99_ms': 250, 'peak_kib': 4096},
+    'generate_report': {'queries': 4, 'p99_ms': 2000, 'peak_kib': 4096},
+    'view_report': {'queries': 3, 'p99_ms': 150, 'peak_kib': 2048},
+    'view_report_sorted': {'queries': 3, 'p99_ms': 500, 'peak_kib': 8192},
+    'api_products': {'queries': 2, 'p99_ms': 100, 'peak_kib': 1024},
+    'api_not_modified': {'queries': 1, 'p99_ms': 20, 'peak_kib': 256},
+    # Cold starts, measured in fresh processes
+    'import': {'p99_ms': 1000},
+    'first_request': {'p99_ms': 500},
+}
+
+# A baseline figure may be exceeded by this fraction, plus a little absolute
+# slack so very fast routes do not fail on timer noise
+DEFAULT_TOLERANCE = 0.25
+SLACK_MS = 2
+
+
+def route_requests(context):
+    """Map route names to functions making one request with a client."""
+    report_range = (f"from_date={context['report_from']}"
+                    f"&to_date={context['report_to']}")
+    report_id = context['report_id']
+    return {
+        'shop': lambda client: client.get('/shop'),
+        'shop_next_page': lambda client: client.get(
+            f"/shop?after={context['shop_cursor']}"),
+        'search': lambda client: client.get('/search?q=' + context['word']),
+        'cart': lambda client: client.get('/cart'),
+        'profile': lambda client: client.get('/profile'),
+        'purchase_details': lambda client: client.get(
+            f"/purchase_details/{context['purchase_event_id']}"),
+        'confirm_purchase': lambda client: client.post(
+            '/confirm_purchase', json={
+                'address_id': context['address_id'],
+                'idempotency_key': next(context['keys'])}),
+        'admin': lambda client: client.get('/admin'),
+        'generate_report': lambda client: client.get(
+            f'/generate_report?{report_range}&download=1'),
+        'view_report': lambda client: client.get(
+            f'/view_report/{report_id}?page=2'),
+        'view_report_sorted': lambda client: client.get(
+            f'/view_report/{report_id}?sort=4&order=desc&page=3'),
+        'api_products': lambda client: client.get(
+            f"/api/products?after={context['shop_cursor']}"),
+        'api_not_modified': lambda client: client.get(
+            f"/api/products?after={context['shop_cursor']}",
+            headers={'If-None-Match': context['api_etag']}),
+    }
+
+
+def fill_cart(client, context):
+    """Put a few products in the cart so there is something to check out."""
+    client.post('/cart/batch', json={'operations': [
+        {'action': 'add', 'product_id': product_id, 'quantity': 1}
+        for product_id in context['cart_products']]})
+
+
+# Run before every request to a route, outside the timed section
+ROUTE_SETUP = {
+    'confirm_purchase': fill_cart,
+}
+
+
+# Run by a fresh interpreter for each cold start; prints its timings as JSON
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.create_app().test_client().get('/shop')
+response.get_data()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import': imported - started,
+                  'first_request': time.perf_counter() - imported}))
+"""
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(client, make_request, setup, repeat, counter):
+    """Time ``repeat`` requests, then trace the memory of one more."""
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        if setup:
+            setup()
+        counter['count'] = 0
+        started = time.perf_counter()
+        response = make_request()
+        # Streamed responses are only generated as they are read
+        response.get_data()
+        timings.append((time.perf_counter() - started) * 1000)
+        queries = max(queries, counter['count'])
+        if response.status_code >= 400:
+            raise click.ClickException(
+                f"{response.request.path} returned {response.status_code}")
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    make_request().get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'p50_ms': round(statistics.median(timings), 2),
+            'p99_ms': round(percentile(timings, 0.99), 2),
+            'queries': queries, 'peak_kib': round(peak / 1024)}
+
+
+def measure_startup(directory, runs):
+    """Time importing the app and its first request in ``runs`` processes."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.abspath(__file__))]
+        + os.environ.get('PYTHONPATH', '').split(os.pathsep)),
+        FLASK_TEMPLATE_CACHE_DIR=os.path.join(directory, 'template-cache'))
+    timings = {'import': [], 'first_request': []}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT], cwd=directory, env=env,
+            capture_output=True, text=True)
+        if output.returncode:
+            raise click.ClickException(output.stderr)
+        for key, seconds in json.loads(output.stdout).items():
+            timings[key].append(seconds * 1000)
+    return {key: {'p50_ms': round(statistics.median(values), 2),
+                  'p99_ms': round(percentile(values, 0.99), 2)}
+            for key, values in timings.items()}
+
+
+def check_result(route, result, baseline, tolerance):
+    """Return a description of every budget or baseline the result misses."""
+    failures = []
+    for key, limit in BUDGETS.get(route, {}).items():
+        if key in result and result[key] > limit:
+            failures.append(f"{key} {result[key]} over budget {limit}")
+    if baseline:
+        # Cold starts only have latencies
+        if 'queries' in result and result['queries'] > baseline['queries']:
+            failures.append(f"queries {result['queries']} up from "
+                            f"{baseline['queries']}")
+        # The p99 of a few dozen requests is too noisy to compare runs by;
+        # it is only held to its budget
+        if result['p50_ms'] > baseline['p50_ms'] * (1 + tolerance) + SLACK_MS:
+            failures.append(f"p50_ms {result['p50_ms']} up from "
+                            f"{baseline['p50_ms']}")
+        if ('peak_kib' in result and result['peak_kib']
+                > baseline['peak_kib'] * (1 + tolerance)):
+            failures.append(f"peak_kib {result['peak_kib']} up from "
+                            f"{baseline['peak_kib']}")
+    return failures
+
+
+def prepare_context(app, db, client, scale):
+    """Log in as an admin and find the ids the route requests need."""
+    from app import Address, Product, PurchaseEvent, Report, User
+
+    with app.app_context():
+        # The buyer of the first order, so there is an order to look at
+        purchase_event = db.session.scalar(
+            db.select(PurchaseEvent).order_by(PurchaseEvent.id))
+        user = db.session.get(User, purchase_event.user_id)
+        user.is_admin = True
+        db.session.commit()
+        address_id = db.session.scalar(db.select(Address.id).where(
+            Address.user_id == user.id).order_by(Address.id))
+        purchase_event_id = purchase_event.id
+        products = db.session.scalars(db.select(Product).order_by(
+            Product.id.desc()).limit(app.config['SHOP_PAGE_SIZE'] + 3)).all()
+        user_id = user.id
+
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+    today = datetime.utcnow().date()
+    context = {
+        'address_id': address_id,
+        'purchase_event_id': purchase_event_id,
+        'shop_cursor': products[app.config['SHOP_PAGE_SIZE'] - 1].id,
+        'cart_products': [product.id for product in products[-3:]],
+        'word': products[0].name.split()[0],
+        'keys': (f'benchmark-{scale}-{number}' for number in range(10 ** 9)),
+        'report_from': (today - timedelta(days=30)).isoformat(),
+        'report_to': today.isoformat(),
+    }
+
+    # Write one report through the usual job for the viewer routes
+    client.get(f"/generate_report?from_date={context['report_from']}"
+               f"&to_date={context['report_to']}")
+    with app.app_context():
+        context['report_id'] = db.session.scalar(
+            db.select(Report.id).order_by(Report.id.desc()))
+    context['api_etag'] = client.get(
+        f"/api/products?after={context['shop_cursor']}").headers['ETag']
+    return context
+
+
+def run_benchmarks(scales, repeat, workers, seed, only, startup_runs):
+    from app import create_app, db
+
+    # Views over their @query_budget fail with a 500 and log the reason
+    app = create_app({'JOBS_RUN_INLINE': True, 'ENFORCE_QUERY_BUDGETS': True})
+    app.logger.setLevel('ERROR')
+
+    counter = {'count': 0}
+
+    def count_statement(*args):
+        counter['count'] += 1
+
+    with app.app_context():
+        for engine in set(db.engines.values()):
+            event.listen(engine, 'before_cursor_execute', count_statement)
+
+    runner = app.test_cli_runner()
+    outcome = runner.invoke(args=['upgrade-db'])
+    if outcome.exit_code:
+        raise click.ClickException(outcome.output)
+    results = {}
+    generated = {key: 0 for key in BASE_DATASET}
+    for scale in scales:
+        # Each scale adds the rows missing from the previous one
+        wanted = {key: count * scale for key, count in BASE_DATASET.items()}
+        click.echo(f"Scale {scale}: generating {wanted['users']} users, "
+                   f"{wanted['products']} products, {wanted['orders']} orders")
+        outcome = runner.invoke(args=[
+            'generate-data', '--seed', str(seed + scale),
+            '--workers', str(workers),
+            '--users', str(wanted['users'] - generated['users']),
+            '--products', str(wanted['products'] - generated['products']),
+            '--orders', str(wanted['orders'] - generated['orders'])])
+        if outcome.exit_code:
+            raise click.ClickException(outcome.output)
+        generated = wanted
+
+        client = app.test_client()
+        context = prepare_context(app, db, client, scale)
+        results[str(scale)] = {}
+        for route, make_request in route_requests(context).items():
+            if only and route not in only:
+                continue
+            setup = ROUTE_SETUP.get(route)
+            results[str(scale)][route] = measure(
+                client, lambda: make_request(client),
+                setup and (lambda: setup(client, context)), repeat, counter)
+
+    if startup_runs:
+        click.echo(f"Timing {startup_runs} cold starts")
+        results['startup'] = measure_startup(os.getcwd(), startup_runs)
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Print the results and return the number of failures."""
+    failures = 0
+    click.echo(f"{'scale':>6} {'route':<20} {'p50 ms':>9} {'p99 ms':>9} "
+               f"{'queries':>7} {'peak KiB':>9}")
+    for scale, routes in results.items():
+        for route, result in routes.items():
+            problems = check_result(
+                route, result, baseline.get(scale, {}).get(route), tolerance)
+            failures += len(problems)
+            verdict = f"  FAIL: {'; '.join(problems)}" if problems else ''
+            click.echo(f"{scale:>6} {route:<20} {result['p50_ms']:>9} "
+                       f"{result['p99_ms']:>9} {result.get('queries', ''):>7} "
+                       f"{result.get('peak_kib', ''):>9}{verdict}")
+    return failures
+
+
+@click.command()
+@click.option('--scales', default='1,10', show_default=True,
+              help="Comma-separated multiples of the base dataset.")
+@click.option('--repeat', default=30, show_default=True,
+              type=click.IntRange(min=1), help="Timed requests per route.")
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--seed', default=0, show_default=True)
+@click.option('--route', 'only', multiple=True,
+              help="Only benchmark this route; may be repeated.")
+@click.option('--startup-runs', default=5, show_default=True,
+              type=click.IntRange(min=0),
+              help="Cold starts to time; 0 skips them.")
+@click.option('--baseline', type=click.Path(dir_okay=False),
+              help="Compare with results saved by --save-baseline.")
+@click.option('--save-baseline', type=click.Path(dir_okay=False),
+              help="Write the results to this file.")
+@click.option('--tolerance', default=DEFAULT_TOLERANCE, show_default=True,
+              help="Fraction by which a baseline figure may be exceeded.")
+def main(scales, repeat, workers, seed, only, startup_runs, baseline,
+         save_baseline, tolerance):
+    """Benchmark the main routes and fail on budget regressions."""
+    scales = sorted(int(scale) for scale in scales.split(','))
+    baseline_path = baseline and os.path.abspath(baseline)
+    save_path = save_baseline and os.path.abspath(save_baseline)
+
+    # The scratch database, uploads and generated reports live in a
+    # temporary directory; the app has to be imported after they are set
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            directory, 'benchmark.db')
+        os.environ['FLASK_UPLOAD_FOLDER'] = os.path.join(directory, 'uploads')
+        os.environ['FLASK_REPORT_FOLDER'] = os.path.join(directory, 'reports')
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        previous = os.getcwd()
+        os.chdir(directory)
+        try:
+            results = run_benchmarks(scales, repeat, workers, seed, only,
+                                     startup_runs)
+        finally:
+            os.chdir(previous)
+
+    baseline_results = {}
+    if baseline_path:
+        with open(baseline_path) as file:
+            baseline_results = json.load(file)
+    failures = report(results, baseline_results, tolerance)
+
+    if save_path:
+        with open(save_path, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        click.echo(f"Saved results to {save_baseline}.")
+    if failures:
+        raise click.ClickException(f"{failures} budget checks failed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Negotiated gzip and brotli compression.
+
+Generated responses are compressed as they leave the app; streamed ones a
+chunk at a time, flushing after each so the client still receives them
+progressively. Files that are served often and never change (static assets,
+finished reports) are compressed once, when they are built or written, into
+``<name>.gz`` and ``<name>.br`` siblings that are sent as they are.
+
+Brotli needs the ``brotli`` package; without it only gzip is offered.
+"""
+import io
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Encodings in the order the server prefers them when the client accepts
+# several equally, and the suffix of their precompressed files
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Precompressed files are made once, so they get a better ratio than
+# responses compressed on the fly; brotli's top levels would be too slow for
+# large reports
+PRECOMPRESS_LEVELS = {'br': 9, 'gzip': 9}
+
+# Content types worth compressing; images, archives and the like already are
+COMPRESSIBLE_TYPES = {
+    'application/javascript', 'application/json', 'application/xml',
+    'image/svg+xml', 'text/css', 'text/csv', 'text/html', 'text/javascript',
+    'text/plain', 'text/xml',
+}
+
+# Static files with these extensions are precompressed
+PRECOMPRESS_EXTENSIONS = ('.css', '.csv', '.html', '.js', '.json', '.svg',
+                          '.txt', '.xml')
+
+
+def available_encodings():
+    return tuple(encoding for encoding in ENCODING_SUFFIXES
+                 if encoding != 'br' or brotli is not None)
+
+
+def choose_encoding(accept_encodings, encodings=None):
+    """Return the encoding the client accepts best, or None for identity.
+
+    ``accept_encodings`` is the request's parsed Accept-Encoding header.
+    """
+    best, best_quality = None, 0
+    if encodings is None:
+        encodings = available_encodings()
+    for encoding in encodings:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class Compressor:
+    """Incremental compression in a single encoding."""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.brotli = brotli.Compressor(quality=level)
+        else:
+            # wbits 31 writes a gzip header and trailer around the stream
+            self.zlib = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.brotli.process(data)
+        return self.zlib.compress(data)
+
+    def flush(self):
+        """Return everything compressed so far, keeping the stream open."""
+        if self.encoding == 'br':
+            return self.brotli.flush()
+        return self.zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self.brotli.finish()
+        return self.zlib.flush()
+
+
+def compress(data, encoding, level):
+    compressor = Compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding, level):
+    """Compress an iterable of byte strings, flushing after each one."""
+    compressor = Compressor(encoding, level)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def is_compressible(response, min_size):
+    """Whether the response may be compressed for a client that accepts it.
+
+    Responses sent straight from files (``direct_passthrough``) are left
+    alone: they are either precompressed or not worth compressing, and may
+    answer range requests.
+    """
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or response.cache_control.no_transform):
+        return False
+    # The size of streamed responses is unknown until they are sent
+    return response.is_streamed or len(response.get_data()) >= min_size
+
+
+def compress_response(response, encoding, levels):
+    """Compress the body of a response in place."""
+    if response.is_streamed:
+        # The server closes the new iterable, which may never be started
+        if hasattr(response.response, 'close'):
+            response.call_on_close(response.response.close)
+        response.response = compress_chunks(
+            response.iter_encoded(), encoding, levels[encoding])
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress(response.get_data(), encoding,
+                                   levels[encoding]))
+    response.content_encoding = encoding
+    # A strong ETag names exact bytes; the compressed body only keeps the
+    # weak meaning, which is what If-None-Match compares
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+class CompressingWriter(io.RawIOBase):
+    """A binary file writing its data to ``file`` and compressed copies.
+
+    ``compressed_files`` maps encodings to the files their copies are
+    written to. Call ``finish`` once everything has been written.
+    """
+
+    def __init__(self, file, compressed_files, levels=PRECOMPRESS_LEVELS):
+        self.file = file
+        self.copies = [(Compressor(encoding, levels[encoding]), copy)
+                       for encoding, copy in compressed_files.items()]
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.file.write(data)
+        for compressor, copy in self.copies:
+            copy.write(compressor.compress(bytes(data)))
+        return len(data)
+
+    def finish(self):
+        for compressor, copy in self.copies:
+            copy.write(compressor.finish())
+
+
+def precompressed_path(path, encoding):
+    return path + ENCODING_SUFFIXES[encoding]
+
+
+def fresh_precompressed_path(path, encoding):
+    """Return the precompressed copy of a file if it is up to date."""
+    compressed = precompressed_path(path, encoding)
+    try:
+        if os.stat(compressed).st_mtime >= os.stat(path).st_mtime:
+            return compressed
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def precompress_directory(directory, min_size, encodings=None):
+    """Write compressed copies of the text files under a directory.
+
+    Copies that are up to date are kept, and files smaller than
+    ``min_size`` or that do not shrink are skipped. Returns the number of
+    copies written.
+    """
+    written = 0
+    for parent, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(parent, filename)
+            if (not filename.endswith(PRECOMPRESS_EXTENSIONS)
+                    or os.path.getsize(path) < min_size):
+                continue
+            with open(path, 'rb') as file:
+                data = None
+                for encoding in encodings or available_encodings():
+                    if fresh_precompressed_path(path, encoding):
+                        continue
+                    if data is None:
+                        data = file.read()
+                    compressed = compress(data, encoding,
+                                          PRECOMPRESS_LEVELS[encoding])
+                    if len(compressed) >= len(data):
+                        continue
+                    target = precompressed_path(path, encoding)
+                    with open(target + '.part', 'wb') as copy:
+                        copy.write(compressed)
+                    os.replace(target + '.part', target)
+                    written += 1
+    return written
@@ -0,0 +1,125 @@
+"""Caches for rendered template fragments.
+
+Every backend stores text by string key, evicts the least recently used
+entries once it holds ``max_entries``, and is safe to use from several
+threads. ``LRUCache`` lives in the worker process; ``SQLiteCache`` keeps
+entries in a local SQLite file so all workers on a host share them; and
+``TieredCache`` puts the first in front of the second.
+"""
+from collections import OrderedDict
+import sqlite3
+import threading
+import time
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteCache:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS fragment ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "accessed REAL NOT NULL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS fragment_accessed "
+                "ON fragment (accessed)")
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT value FROM fragment WHERE key = ?",
+                    (key,)).fetchone()
+                if row is not None:
+                    connection.execute(
+                        "UPDATE fragment SET accessed = ? WHERE key = ?",
+                        (time.time(), key))
+        except sqlite3.OperationalError:
+            # A busy shared tier is treated as a miss rather than an error
+            return None
+        return row[0] if row else None
+
+    def set(self, key, value):
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO fragment (key, value, accessed) "
+                    "VALUES (?, ?, ?)", (key, value, time.time()))
+                connection.execute(
+                    "DELETE FROM fragment WHERE key IN (SELECT key FROM "
+                    "fragment ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+        except sqlite3.OperationalError:
+            pass
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM fragment")
+
+
+class TieredCache:
+    """Checks the local cache first and fills it from the shared one."""
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        self.shared.set(key, value)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+
+def make_fragment_cache(max_entries, shared_path=None):
+    local = LRUCache(max_entries)
+    if shared_path:
+        return TieredCache(local, SQLiteCache(shared_path, max_entries))
+    return local
@@ -0,0 +1,199 @@
+"""Storage and resizing of uploaded product images.
+
+Uploads are stored under the SHA-256 of their content in sharded
+keys (``ab/cd/abcd....jpg``) of a storage backend (see storage.py), so the
+same photo uploaded twice is stored once and different photos with the same
+name never overwrite each other. Smaller WebP and JPEG variants are
+generated in a worker pool after the upload has been saved; until they
+exist the original is served in their place.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import importlib.util
+import os
+import re
+import tempfile
+
+# Pillow is optional; variants are skipped without it. It is only imported
+# by the worker threads, when the first image is resized.
+PILLOW_AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+# Widths of the generated variants, in pixels
+VARIANT_WIDTHS = (320, 640)
+VARIANT_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+VARIANT_QUALITY = 80
+CHUNK_SIZE = 64 * 1024
+
+# A variant of "ab/cd/<hash>.png" is named "ab/cd/<hash>.png.320.webp"
+VARIANT_PATTERN = re.compile(r'^(?P<original>.+)\.(?P<width>\d+)\.'
+                             r'(?P<format>webp|jpg)$')
+
+
+# Names produced by store_upload, and variants of them
+CONTENT_ADDRESSED_PATTERN = re.compile(
+    r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}')
+
+# Image formats accepted as uploads, by Pillow format name, and the
+# extension they are stored under
+UPLOAD_FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif',
+                  'WEBP': '.webp'}
+
+# Leading bytes of the accepted formats, checked when Pillow is missing
+UPLOAD_SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+)
+
+# Uploads are only ever sent as images; older uploads stored under another
+# extension are sent as opaque downloads
+UPLOAD_MIMETYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg',
+                    '.png': 'image/png', '.gif': 'image/gif',
+                    '.webp': 'image/webp'}
+
+
+class NotAnImage(ValueError):
+    """Raised when an upload is not a JPEG, PNG, GIF or WebP image."""
+
+
+def is_content_addressed(filename):
+    """Whether the file's content is fixed by its name."""
+    return bool(CONTENT_ADDRESSED_PATTERN.match(filename))
+
+
+def shard_path(digest, extension):
+    return f'{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+def variant_name(filename, width, image_format):
+    return f'{filename}.{width}.{image_format}'
+
+
+def original_name(variant):
+    """Return the original a variant was made from, or None."""
+    match = VARIANT_PATTERN.match(variant)
+    return match.group('original') if match else None
+
+
+def upload_mimetype(filename):
+    """Return the content type an upload or variant is served with."""
+    extension = os.path.splitext(filename)[1].lower()
+    return UPLOAD_MIMETYPES.get(extension, 'application/octet-stream')
+
+
+def detect_image_format(path):
+    """Return the Pillow format name of an accepted image file, or None.
+
+    Pillow checks that the whole file parses; without it only the leading
+    bytes are compared.
+    """
+    if PILLOW_AVAILABLE:
+        from PIL import Image
+
+        try:
+            with Image.open(path) as image:
+                image_format = image.format
+                image.verify()
+        except Exception:  # Pillow raises many kinds on a corrupt file
+            return None
+        return image_format if image_format in UPLOAD_FORMATS else None
+
+    with open(path, 'rb') as file:
+        header = file.read(12)
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP'
+    for signature, image_format in UPLOAD_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return None
+
+
+def store_upload(file, storage):
+    """Save an uploaded image under its content hash and return its name.
+
+    The upload is hashed while it is streamed to a temporary file, which is
+    then moved into storage, or dropped if the same content is already
+    stored. Its extension comes from the detected format, never from the
+    client's filename; anything but a JPEG, PNG, GIF or WebP image raises
+    NotAnImage.
+    """
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=storage.temp_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                temp_file.write(chunk)
+
+        image_format = detect_image_format(temp_path)
+        if image_format is None:
+            raise NotAnImage("Please upload a JPEG, PNG, GIF or WebP image.")
+        filename = shard_path(digest.hexdigest(),
+                              UPLOAD_FORMATS[image_format])
+        if storage.exists(filename):
+            os.remove(temp_path)
+        else:
+            storage.put_file(temp_path, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return filename
+
+
+def generate_variants(storage, filename):
+    """Write every resized variant of an image that does not exist yet."""
+    if not PILLOW_AVAILABLE:
+        return
+    from PIL import Image, ImageOps
+
+    with Image.open(storage.fetch(filename)) as image:
+        # Apply the camera orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands()
+                                  else 'RGB')
+        for width in VARIANT_WIDTHS:
+            resized = image.copy()
+            resized.thumbnail((width, width * 4))
+            for extension, image_format in VARIANT_FORMATS.items():
+                variant_key = variant_name(filename, width, extension)
+                if storage.exists(variant_key):
+                    continue
+                variant = resized
+                if image_format == 'JPEG' and variant.mode != 'RGB':
+                    variant = variant.convert('RGB')
+                # The storage only exposes the variant once it is complete,
+                # even if the same image is processed twice
+                with storage.open_write(variant_key) as file:
+                    variant.save(file, image_format,
+                                 quality=VARIANT_QUALITY, optimize=True)
+
+
+class ImagePipeline:
+    """Generates image variants on a small pool of worker threads."""
+
+    def __init__(self, max_workers, logger):
+        self.logger = logger
+        # Threads are only started once the first image is submitted
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='images')
+
+    def submit(self, storage, filename):
+        if not PILLOW_AVAILABLE:
+            return None
+        return self.executor.submit(self._run, storage, filename)
+
+    def _run(self, storage, filename):
+        try:
+            generate_variants(storage, filename)
+        except Exception:
+            self.logger.exception("Could not resize image %s", filename)
+
+
+def srcset(url_for_file, filename, image_format):
+    """Build a srcset attribute listing every variant width of an image."""
+    return ', '.join(
+        f'{url_for_file(variant_name(filename, width, image_format))} {width}w'
+        for width in VARIANT_WIDTHS)
@@ -0,0 +1,79 @@
+"""Request metrics in the Prometheus text exposition format.
+
+Histograms are kept in memory by each worker process and rendered when the
+metrics endpoint is scraped. Several worker processes each report their own
+figures, so scrape them per instance and sum them in Prometheus.
+"""
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets for durations, in seconds, and for
+# per-request counts
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def escape_label(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def format_bound(bound):
+    return f'{bound:g}'
+
+
+class Histogram:
+    def __init__(self, name, documentation, label, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        # Label value -> [per-bucket counts, sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((label_value, list(counts), total, count)
+                            for label_value, (counts, total, count)
+                            in self.series.items())
+        for label_value, counts, total, count in series:
+            label = f'{self.label}="{escape_label(label_value)}"'
+            cumulative = 0
+            # Buckets are cumulative in the exposition format
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},'
+                             f'le="{format_bound(bound)}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return '\n'.join(lines)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, documentation, label, buckets=DURATION_BUCKETS):
+        histogram = Histogram(name, documentation, label, buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self):
+        return '\n\n'.join(metric.render() for metric in self.metrics) + '\n'
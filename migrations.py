@@ -0,0 +1,177 @@
+"""Versioned schema changes for existing databases.
+
+``db.create_all()`` only creates missing tables, so anything added to an
+existing table (indexes, constraints, columns) is listed here as well. Each
+migration has a version number and is applied once, in order; the highest
+applied version is recorded in the ``schema_version`` table. Statements must
+be safe to run on a database that ``create_all()`` has just created with
+the current models. A step is either an SQL string or a function taking
+the connection, for changes SQL alone cannot make conditional.
+"""
+import re
+
+from sqlalchemy import inspect, text
+
+
+def add_column(table, column, definition):
+    """Step that adds a column unless the table already has it."""
+    def step(connection):
+        columns = {info['name'] for info in
+                   inspect(connection).get_columns(table)}
+        if column not in columns:
+            connection.exec_driver_sql(
+                f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+def use_autoincrement(table, referencing_columns):
+    """Step that rebuilds a SQLite table with an AUTOINCREMENT id.
+
+    Without it SQLite hands out the ids of deleted rows again, so rows that
+    still refer to a deleted row would end up pointing at a new one. The
+    sequence starts after every id found in ``referencing_columns``
+    (``table.column`` names) as well.
+    """
+    def step(connection):
+        if connection.dialect.name != 'sqlite':
+            return  # Other databases never reuse sequence values
+        create_sql = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' "
+            "AND name = ?", (table,)).scalar()
+        if 'AUTOINCREMENT' in create_sql.upper():
+            return
+        # Move the primary key onto the id column, where AUTOINCREMENT goes
+        new_sql, columns = re.subn(
+            r'\bid INTEGER NOT NULL,',
+            'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,', create_sql,
+            count=1)
+        new_sql, keys = re.subn(r',\s*PRIMARY KEY \(id\)', '', new_sql)
+        new_sql, names = re.subn(rf'^CREATE TABLE "?{table}"?',
+                                 f'CREATE TABLE {table}_new', new_sql)
+        if (columns, keys, names) != (1, 1, 1):
+            raise RuntimeError(f"Unexpected definition of {table}: "
+                               f"{create_sql}")
+        index_sql = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = ? AND sql IS NOT NULL", (table,)).scalars().all()
+
+        connection.exec_driver_sql(new_sql)
+        connection.exec_driver_sql(
+            f"INSERT INTO {table}_new SELECT * FROM {table}")
+        connection.exec_driver_sql(f"DROP TABLE {table}")
+        connection.exec_driver_sql(
+            f"ALTER TABLE {table}_new RENAME TO {table}")
+        for sql in index_sql:
+            connection.exec_driver_sql(sql)
+
+        last_id = max(connection.exec_driver_sql(
+            f"SELECT COALESCE(MAX({column.split('.')[1]}), 0) "
+            f"FROM {column.split('.')[0]}").scalar()
+            for column in [f'{table}.id', *referencing_columns])
+        connection.exec_driver_sql(
+            "DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        connection.exec_driver_sql(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+            (table, last_id))
+    return step
+
+
+# Purchases made before their price was stored are taken to have been at
+# the product's current price; those of deleted products stay unknown
+PURCHASE_UNIT_PRICES = [
+    add_column('purchase', 'unit_price', 'FLOAT'),
+    "UPDATE purchase SET unit_price = (SELECT price FROM product "
+    "WHERE product.id = purchase.product_id) WHERE unit_price IS NULL",
+]
+
+MIGRATIONS = [
+    (1, "Indexes and uniqueness for hot lookups", [
+        # Keep the oldest row of any duplicated cart item so the unique
+        # index can be built
+        "DELETE FROM cart WHERE id NOT IN "
+        "(SELECT MIN(id) FROM cart GROUP BY user_id, product_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_cart_user_product "
+        "ON cart (user_id, product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_cart_product_id ON cart (product_id)",
+        "CREATE INDEX IF NOT EXISTS ix_address_user_id ON address (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_product_user_id ON product (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_purchase_event_user_date "
+        "ON purchase_event (user_id, purchase_date)",
+        "CREATE INDEX IF NOT EXISTS ix_purchase_event_purchase_date "
+        "ON purchase_event (purchase_date)",
+        "CREATE INDEX IF NOT EXISTS ix_purchase_purchase_event_id "
+        "ON purchase (purchase_event_id)",
+        "CREATE INDEX IF NOT EXISTS ix_purchase_product_id "
+        "ON purchase (product_id)",
+    ]),
+    (2, "Idempotency keys for checkout", [
+        add_column('purchase_event', 'idempotency_key', 'VARCHAR(64)'),
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_purchase_event_idempotency_key "
+        "ON purchase_event (user_id, idempotency_key)",
+    ]),
+    (3, "Backfill the sales rollups from existing purchases", [
+        # The rollups sum the prices stored on the purchases (see 7)
+        *PURCHASE_UNIT_PRICES,
+        "DELETE FROM daily_sales",
+        "DELETE FROM product_sales",
+        "INSERT INTO daily_sales (day, orders, units, revenue) "
+        "SELECT date(e.purchase_date), COUNT(DISTINCT e.id), SUM(p.quantity), "
+        "SUM(p.quantity * COALESCE(p.unit_price, 0)) "
+        "FROM purchase_event e JOIN purchase p ON p.purchase_event_id = e.id "
+        "GROUP BY date(e.purchase_date)",
+        "INSERT INTO product_sales (day, product_id, orders, units, revenue) "
+        "SELECT date(e.purchase_date), p.product_id, COUNT(DISTINCT e.id), "
+        "SUM(p.quantity), SUM(p.quantity * COALESCE(p.unit_price, 0)) "
+        "FROM purchase_event e JOIN purchase p ON p.purchase_event_id = e.id "
+        "GROUP BY date(e.purchase_date), p.product_id",
+    ]),
+    (4, "Report paths become keys in the report storage", [
+        "UPDATE report SET file_path = substr(file_path, 9) "
+        "WHERE file_path LIKE 'reports/%'",
+    ]),
+    (5, "Ids of deleted products are never reused", [
+        use_autoincrement('product', ['purchase.product_id',
+                                      'product_sales.product_id']),
+    ]),
+    (6, "Job owners and heartbeats", [
+        add_column('job', 'owner', 'VARCHAR(100)'),
+        add_column('job', 'heartbeat_at', 'DATETIME'),
+    ]),
+    (7, "Purchases keep the price they were bought at",
+     PURCHASE_UNIT_PRICES),
+    (8, "Indexes for the catalog filters", [
+        "CREATE INDEX IF NOT EXISTS ix_product_condition_id "
+        "ON product (condition, id)",
+        "CREATE INDEX IF NOT EXISTS ix_product_price_id "
+        "ON product (price, id)",
+        "CREATE INDEX IF NOT EXISTS ix_product_rating_id "
+        "ON product (rating, id)",
+    ]),
+]
+
+
+def current_version(connection):
+    connection.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    version = connection.exec_driver_sql(
+        "SELECT MAX(version) FROM schema_version").scalar()
+    return version or 0
+
+
+def upgrade(connection):
+    """Apply every pending migration; returns the versions applied."""
+    applied = []
+    version = current_version(connection)
+    for number, _description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+        for statement in statements:
+            if callable(statement):
+                statement(connection)
+            else:
+                connection.exec_driver_sql(statement)
+        connection.execute(text(
+            "INSERT INTO schema_version (version) VALUES (:version)"),
+            {'version': number})
+        applied.append(number)
+    return applied
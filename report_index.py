@@ -0,0 +1,175 @@
+"""Random access to large CSV report files.
+
+A report is indexed once by recording the byte offset at which every CSV
+record starts. The offsets are kept in a sidecar file next to the report, so
+any page of rows can be read by seeking straight to it through an mmap,
+without parsing the rows before it. Sorting by a column is backed by a
+persisted row order for that column, built from a single pass that only
+keeps that column's values in memory.
+"""
+from array import array
+import csv
+import glob
+import io
+import mmap
+import os
+
+INDEX_SUFFIX = '.idx'
+
+
+def index_path(csv_path, name='rows'):
+    return f'{csv_path}.{name}{INDEX_SUFFIX}'
+
+
+def remove_index_files(csv_path):
+    """Delete every index file built for a report."""
+    pattern = glob.escape(csv_path) + '.*' + INDEX_SUFFIX
+    for path in glob.glob(pattern):
+        os.remove(path)
+
+
+def sort_key(value):
+    # Numbers sort numerically and before text
+    try:
+        return (0, float(value), '')
+    except ValueError:
+        return (1, 0.0, value.lower())
+
+
+class ReportIndex:
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        stat = os.stat(csv_path)
+        # Index files start with the size and mtime of the report they were
+        # built from, so a rewritten report is never read with a stale index
+        self.stamp = (stat.st_size, stat.st_mtime_ns)
+        self.offsets = self._load(index_path(csv_path)) or self._build()
+        self.header = self._read_range(0, 1)[0] if self.offsets else []
+
+    @property
+    def row_count(self):
+        """Number of data rows, not counting the header."""
+        return max(len(self.offsets) - 1, 0)
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return None
+        values = array('Q')
+        with open(path, 'rb') as file:
+            values.frombytes(file.read())
+        if tuple(values[:2]) != self.stamp:
+            return None
+        return values[2:]
+
+    def _save(self, path, values):
+        data = array('Q', self.stamp)
+        data.extend(values)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            data.tofile(file)
+        os.replace(temp_path, path)
+
+    def _build(self):
+        """Record the start offset of every record, header included."""
+        offsets = array('Q')
+        position = 0
+        in_quotes = False
+        with open(self.csv_path, 'rb') as file:
+            for line in file:
+                if not in_quotes:
+                    offsets.append(position)
+                # A quoted field may span lines; an odd number of quotes on
+                # a line toggles whether the record continues on the next
+                if line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                position += len(line)
+        self._save(index_path(self.csv_path), offsets)
+        return offsets
+
+    def _record_bounds(self, record):
+        start = self.offsets[record]
+        if record + 1 < len(self.offsets):
+            return start, self.offsets[record + 1]
+        return start, self.stamp[0]
+
+    def _read_range(self, first, last):
+        """Parse records ``first`` to ``last`` (exclusive), header is 0."""
+        if first >= last:
+            return []
+        start = self._record_bounds(first)[0]
+        end = self._record_bounds(last - 1)[1]
+        with open(self.csv_path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            text = data[start:end].decode('utf-8')
+        return list(csv.reader(io.StringIO(text, newline='')))
+
+    def _read_row(self, data, row):
+        start, end = self._record_bounds(row + 1)
+        text = data[start:end].decode('utf-8')
+        return next(csv.reader(io.StringIO(text, newline='')))
+
+    def _iter_rows(self, order):
+        """Yield (row number, row) for data rows in the given order."""
+        if not self.row_count:
+            return
+        with open(self.csv_path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for row in order:
+                yield row, self._read_row(data, row)
+
+    def sort_order(self, column):
+        """Return data row numbers ordered by ``column``, building it once."""
+        path = index_path(self.csv_path, f'sort{column}')
+        order = self._load(path)
+        if order is None:
+            keys = [sort_key(row[column]) if column < len(row) else (2, 0, '')
+                    for _, row in self._iter_rows(range(self.row_count))]
+            order = array('Q', sorted(range(len(keys)), key=keys.__getitem__))
+            del keys
+            self._save(path, order)
+        return order
+
+    def ordered_rows(self, sort_column=None, descending=False):
+        """Return the data row numbers in display order."""
+        if sort_column is None:
+            order = range(self.row_count)
+        else:
+            order = self.sort_order(sort_column)
+        return order[::-1] if descending else order
+
+    def page(self, start, count, sort_column=None, descending=False,
+             filter_column=None, filter_text=None):
+        """Return ``count`` rows starting at ``start`` and whether more exist.
+
+        Without a filter only the requested rows are read. With a filter the
+        rows are scanned in order until the page is filled, keeping only the
+        page in memory.
+        """
+        order = self.ordered_rows(sort_column, descending)
+
+        if not filter_text:
+            has_next = start + count < self.row_count
+            if sort_column is None and not descending:
+                # Rows are contiguous in the file; skip the header record
+                last = min(start + count, self.row_count)
+                return self._read_range(start + 1, last + 1), has_next
+            rows = self._iter_rows(order[start:start + count])
+            return [row for _, row in rows], has_next
+
+        needle = filter_text.lower()
+        rows = []
+        skipped = 0
+        for _, row in self._iter_rows(order):
+            if filter_column is None:
+                cells = row
+            else:
+                cells = row[filter_column:filter_column + 1]
+            if not any(needle in cell.lower() for cell in cells):
+                continue
+            if skipped < start:
+                skipped += 1
+                continue
+            if len(rows) == count:
+                return rows, True
+            rows.append(row)
+        return rows, False
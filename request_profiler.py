@@ -0,0 +1,83 @@
+"""On-disk store for profiles of slow requests.
+
+Each profile is a cProfile dump (``<name>.prof``, readable with pstats or
+snakeviz) next to a JSON file describing the request it came from. Only the
+newest ``max_files`` profiles are kept.
+"""
+from datetime import datetime
+import io
+import json
+import os
+import pstats
+import re
+
+PROFILE_SUFFIX = '.prof'
+METADATA_SUFFIX = '.json'
+
+# Names are generated by ProfileStore.save and checked before being used as
+# paths
+NAME_PATTERN = re.compile(r'^\d{8}-\d{6}-\d{6}-[A-Za-z0-9_.]+$')
+
+
+class ProfileStore:
+    def __init__(self, directory, max_files):
+        self.directory = directory
+        self.max_files = max_files
+
+    def path(self, name, suffix=PROFILE_SUFFIX):
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid profile name: {name}")
+        return os.path.join(self.directory, name + suffix)
+
+    def save(self, profiler, metadata):
+        """Write a finished profiler's stats and return the profile name."""
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = re.sub(r'[^A-Za-z0-9_.]', '_', metadata['endpoint'])
+        name = f"{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{endpoint}"
+        profiler.dump_stats(self.path(name))
+        # The metadata is written last; profiles without it are not listed
+        with open(self.path(name, METADATA_SUFFIX), 'w') as file:
+            json.dump(dict(metadata, name=name), file)
+        self.rotate()
+        return name
+
+    def names(self):
+        """Names of the stored profiles, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(filename[:-len(METADATA_SUFFIX)]
+                      for filename in os.listdir(self.directory)
+                      if filename.endswith(METADATA_SUFFIX))
+
+    def rotate(self):
+        for name in self.names()[:-self.max_files or None]:
+            self.delete(name)
+
+    def delete(self, name):
+        for suffix in (METADATA_SUFFIX, PROFILE_SUFFIX):
+            try:
+                os.remove(self.path(name, suffix))
+            except FileNotFoundError:
+                pass
+
+    def metadata(self, name):
+        with open(self.path(name, METADATA_SUFFIX)) as file:
+            return json.load(file)
+
+    def slowest(self, limit=None):
+        """Metadata of the stored profiles, slowest request first."""
+        profiles = []
+        for name in self.names():
+            try:
+                profiles.append(self.metadata(name))
+            except (FileNotFoundError, ValueError):
+                continue  # Rotated away or half written
+        profiles.sort(key=lambda profile: profile['duration'], reverse=True)
+        return profiles[:limit]
+
+    def summary(self, name, sort='cumulative', limit=40):
+        """The top functions of a profile as pstats prints them."""
+        output = io.StringIO()
+        stats = pstats.Stats(self.path(name), stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        return output.getvalue()
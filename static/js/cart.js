@@ -0,0 +1,37 @@
+// Send a batch of cart operations, e.g. [{action: 'add', product_id: 1}],
+// and update the cart badge from the returned summary.
+function updateCart(operations) {
+    return fetch('/cart/batch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ operations: operations })
+    })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`Cart update failed (${response.status})`);
+        }
+        return response.json();
+    })
+    .then(summary => {
+        document.querySelectorAll('.cart-count').forEach(badge => {
+            badge.textContent = summary.cart_count;
+        });
+        return summary;
+    });
+}
+
+// Return the quantity typed into an input, or null after pointing out the
+// problem unless it is a whole number of at least 1. An empty input would
+// otherwise be sent as 0, which removes the item.
+function readQuantity(input) {
+    const quantity = Number(input.value);
+    if (input.value.trim() === '' || !Number.isInteger(quantity) || quantity < 1) {
+        input.setCustomValidity('Enter a quantity of at least 1.');
+        input.reportValidity();
+        return null;
+    }
+    input.setCustomValidity('');
+    return quantity;
+}
@@ -1,13 +1,37 @@
-function filterItems() {
-    let input = document.getElementById('search-bar').value.toLowerCase();
-    let items = document.querySelectorAll('.item-card');
+let searchTimer = null;
 
-    items.forEach(item => {
-        let itemName = item.querySelector('h2').innerText.toLowerCase();
-        if (itemName.includes(input)) {
-            item.style.display = '';
-        } else {
-            item.style.display = 'none';
-        }
-    });
-}
\ No newline at end of file
+// Search runs on the server; submit the search form once the user
+// stops typing instead of filtering the cards already on the page.
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(function() {
+        document.getElementById('search-form').submit();
+    }, 500);
+}
+
+// Keep the caret at the end of the query after the page reloads
+document.addEventListener('DOMContentLoaded', function() {
+    const searchBar = document.getElementById('search-bar');
+    if (searchBar && searchBar.value) {
+        searchBar.setSelectionRange(searchBar.value.length, searchBar.value.length);
+    }
+});
+
+// Add items to the cart in place; if that fails (e.g. not logged in) the
+// form is posted normally so the server can redirect with a message.
+document.addEventListener('submit', function(event) {
+    const form = event.target.closest('.add-to-cart-form');
+    if (!form) {
+        return;
+    }
+    event.preventDefault();
+    const button = form.querySelector('button');
+    button.disabled = true;
+    updateCart([{ action: 'add', product_id: Number(form.dataset.productId) }])
+        .then(() => {
+            button.textContent = 'Added to Cart';
+        })
+        .catch(() => {
+            form.submit();
+        });
+});
@@ -0,0 +1,293 @@
+"""Where uploaded images and generated reports are kept.
+
+Files are addressed by a relative key such as ``ab/cd/<hash>.jpg``.
+``LocalStorage`` keeps them under a directory, which several hosts can share
+over a network filesystem. ``S3Storage`` keeps them in an S3-compatible
+bucket (AWS, MinIO, or a local stand-in such as ``moto_server``), so any
+number of workers and nodes, serverless ones included, see the same files.
+
+Writes are streamed and only become visible once complete. ``serve``
+answers a download: local files are sent with range and conditional request
+support, and S3 objects either by redirecting the client to a short-lived
+presigned URL, so the bytes never pass through a web worker, or by streaming
+them through with the client's Range header forwarded. Code that needs a
+real file (Pillow, the report index's mmap) calls ``fetch``; S3 objects are
+then cached on local disk, which is safe because a stored key is never
+rewritten with different content.
+"""
+from contextlib import contextmanager
+import mimetypes
+import os
+import posixpath
+import shutil
+import tempfile
+
+from flask import Response, redirect, request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.http import http_date
+
+CHUNK_SIZE = 64 * 1024
+
+
+def check_key(key):
+    """Reject keys that could escape the storage root."""
+    normalized = posixpath.normpath(key)
+    if (not key or key.startswith('/') or '\\' in key
+            or normalized != key or normalized.startswith('..')):
+        raise ValueError(f"Invalid storage key: {key!r}")
+    return key
+
+
+def cache_control_header(max_age, immutable):
+    if max_age is None:
+        return 'no-cache'
+    return f"public, max-age={max_age}" + (', immutable' if immutable else '')
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+
+    @property
+    def temp_dir(self):
+        # Temporary files are made here so moving them into place is atomic
+        os.makedirs(self.root, exist_ok=True)
+        return self.root
+
+    def local_path(self, key):
+        return os.path.join(self.root, check_key(key))
+
+    def fetch(self, key):
+        """Return the path of the stored file."""
+        path = self.local_path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(key)
+        return path
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    @contextmanager
+    def open_write(self, key):
+        """Write a file through a binary file object, replacing it at the end.
+
+        Nothing is stored if the block raises.
+        """
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                yield file
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def put_file(self, source_path, key):
+        """Move a finished local file into the store."""
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(source_path, path)
+
+    def open_read(self, key):
+        return open(self.fetch(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def serve(self, key, download_name=None, max_age=None, immutable=False,
+              content_type=None, content_encoding=None):
+        try:
+            path = self.fetch(key)
+        except FileNotFoundError:
+            raise NotFound()
+        # send_file answers Range and If-None-Match/If-Modified-Since itself
+        response = send_file(path, mimetype=content_type,
+                             as_attachment=download_name is not None,
+                             download_name=download_name, max_age=max_age,
+                             conditional=True)
+        if content_encoding:
+            response.content_encoding = content_encoding
+        if immutable:
+            response.cache_control.immutable = True
+        return response
+
+
+class S3Storage:
+    def __init__(self, bucket, prefix='', cache_dir=None, endpoint_url=None,
+                 region=None, presigned_urls=True, presigned_url_expiry=300,
+                 client=None):
+        if client is None:
+            # boto3 is optional and slow to import, so only loaded here
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError("The S3 storage backend needs boto3 "
+                                   "(pip install boto3).") from None
+            client = boto3.client('s3', endpoint_url=endpoint_url,
+                                  region_name=region)
+        self.client = client
+        self.ClientError = client.exceptions.ClientError
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = cache_dir or os.path.join(
+            tempfile.gettempdir(), 'storage-cache', bucket, prefix)
+        # Uploads are hashed into a local temporary file before being sent
+        self.temp_dir = None
+        self.presigned_urls = presigned_urls
+        self.presigned_url_expiry = presigned_url_expiry
+
+    def object_key(self, key):
+        return self.prefix + check_key(key)
+
+    def local_path(self, key):
+        """Where the local copy of an object is cached."""
+        return os.path.join(self.cache_dir, check_key(key))
+
+    def fetch(self, key):
+        """Return the path of a local copy, downloading it if needed."""
+        path = self.local_path(key)
+        if os.path.isfile(path):
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                self.client.download_fileobj(
+                    self.bucket, self.object_key(key), file)
+            os.replace(temp_path, path)
+        except self.ClientError as error:
+            os.remove(temp_path)
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key) from error
+            raise
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return path
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket,
+                                    Key=self.object_key(key))
+        except self.ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return True
+
+    @contextmanager
+    def open_write(self, key):
+        """Write an object through a binary file object.
+
+        The data is spooled to a temporary file and uploaded (in parts, when
+        large) once the block finishes; nothing is stored if it raises.
+        """
+        object_key = self.object_key(key)
+        with tempfile.TemporaryFile() as file:
+            yield file
+            file.seek(0)
+            self.client.upload_fileobj(
+                file, self.bucket, object_key, ExtraArgs=self.extra_args(key))
+
+    def put_file(self, source_path, key):
+        """Upload a finished local file, keeping it as the cached copy."""
+        self.client.upload_file(source_path, self.bucket,
+                                self.object_key(key),
+                                ExtraArgs=self.extra_args(key))
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(source_path, path)
+
+    def extra_args(self, key):
+        content_type = mimetypes.guess_type(key)[0]
+        return {'ContentType': content_type} if content_type else {}
+
+    def open_read(self, key):
+        """Return a streaming, file-like body of the object."""
+        try:
+            return self.client.get_object(
+                Bucket=self.bucket, Key=self.object_key(key))['Body']
+        except self.ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key) from error
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket,
+                                  Key=self.object_key(key))
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def serve(self, key, download_name=None, max_age=None, immutable=False,
+              content_type=None, content_encoding=None):
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key),
+                  'ResponseCacheControl': cache_control_header(
+                      max_age, immutable)}
+        if download_name is not None:
+            params['ResponseContentDisposition'] = (
+                f'attachment; filename="{download_name}"')
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if content_encoding:
+            params['ResponseContentEncoding'] = content_encoding
+        if not self.presigned_urls:
+            return self.stream(params)
+
+        url = self.client.generate_presigned_url(
+            'get_object', Params=params, ExpiresIn=self.presigned_url_expiry)
+        response = redirect(url)
+        # The redirect must not outlive the URL it points to
+        response.cache_control.private = True
+        response.cache_control.max_age = self.presigned_url_expiry // 2
+        return response
+
+    def stream(self, params):
+        """Stream an object through the app, honouring Range and ETags."""
+        params = dict(params)
+        if request.range:
+            params['Range'] = request.headers['Range']
+        if request.if_none_match:
+            params['IfNoneMatch'] = request.headers['If-None-Match']
+        try:
+            result = self.client.get_object(**params)
+        except self.ClientError as error:
+            code = error.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return Response(status=304)
+            if code in ('404', 'NoSuchKey'):
+                raise NotFound()
+            if code == 'InvalidRange':
+                return Response(status=416)
+            raise
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Length': str(result['ContentLength']),
+            'ETag': result['ETag'],
+            'Last-Modified': http_date(result['LastModified']),
+            'Cache-Control': result.get('CacheControl')
+            or params['ResponseCacheControl'],
+        }
+        if result.get('ContentDisposition'):
+            headers['Content-Disposition'] = result['ContentDisposition']
+        if result.get('ContentEncoding'):
+            headers['Content-Encoding'] = result['ContentEncoding']
+        status = 200
+        if result.get('ContentRange'):
+            headers['Content-Range'] = result['ContentRange']
+            status = 206
+        body = result['Body']
+        return Response(body.iter_chunks(CHUNK_SIZE), status=status,
+                        headers=headers,
+                        content_type=result.get('ContentType'),
+                        direct_passthrough=True)
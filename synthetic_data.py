@@ -0,0 +1,184 @@
+"""Deterministic synthetic data for load testing.
+
+Rows are generated in chunks. Every chunk seeds its own random generator and
+Faker instance from the base seed and the chunk's position, so the same plan
+always produces the same data however many worker processes generate it.
+Ids are assigned up front, continuing after the rows already stored, which
+lets chunks refer to each other's rows without reading anything back from
+the database.
+"""
+from datetime import timedelta
+from multiprocessing import Pool
+import random
+
+from faker import Faker
+
+# Tables in the order they are filled, with the number of units each chunk
+# covers; carts are generated per user and purchases per order
+TABLE_ORDER = ('user', 'address', 'product', 'cart', 'purchase_event')
+
+ADDRESS_LABELS = ('Home', 'Work', 'Other')
+
+# Set in every worker process by use_plan()
+_plan = None
+_faker = None
+
+
+def make_plan(seed, users, products, orders, addresses_per_user, cart_items,
+              max_order_items, end_date, days, first_ids, password_hash,
+              conditions, images):
+    """Collect everything the generators need into a picklable dict.
+
+    ``first_ids`` maps 'user', 'address', 'product' and 'purchase_event' to
+    the first free id of each table.
+    """
+    return {
+        'seed': seed, 'users': users, 'products': products,
+        'orders': orders, 'addresses_per_user': addresses_per_user,
+        'cart_items': min(cart_items, products), 'max_order_items':
+        min(max_order_items, products), 'end_date': end_date, 'days': days,
+        'first_ids': first_ids, 'password_hash': password_hash,
+        'conditions': list(conditions), 'images': list(images),
+    }
+
+
+def unit_counts(plan):
+    """Number of units to generate for each table in TABLE_ORDER."""
+    return {
+        'user': plan['users'],
+        'address': plan['users'] * plan['addresses_per_user'],
+        'product': plan['products'],
+        'cart': plan['users'] if plan['cart_items'] else 0,
+        'purchase_event': plan['orders'],
+    }
+
+
+def plan_chunks(plan, batch_size):
+    """Split the work into (table, start, count) chunks, in insert order."""
+    counts = unit_counts(plan)
+    return [(table, start, min(batch_size, counts[table] - start))
+            for table in TABLE_ORDER
+            for start in range(0, counts[table], batch_size)]
+
+
+def use_plan(plan):
+    global _plan
+    _plan = plan
+
+
+def chunk_generators(table, start):
+    """Random and Faker instances seeded for one chunk."""
+    global _faker
+    rng = random.Random(f"{_plan['seed']}:{table}:{start}")
+    if _faker is None:
+        _faker = Faker()
+    _faker.seed_instance(rng.getrandbits(64))
+    return rng, _faker
+
+
+def generate_users(start, count, rng, fake):
+    first = _plan['first_ids']['user']
+    return {'user': [
+        {'id': first + index,
+         'email': f"{fake.user_name()}.{first + index}@example.com",
+         'password': _plan['password_hash'], 'is_admin': False}
+        for index in range(start, start + count)]}
+
+
+def generate_addresses(start, count, rng, fake):
+    first = _plan['first_ids']['address']
+    first_user = _plan['first_ids']['user']
+    per_user = _plan['addresses_per_user']
+    return {'address': [
+        {'id': first + index, 'user_id': first_user + index // per_user,
+         'street': fake.street_address(), 'city': fake.city(),
+         'state': fake.state(), 'zip_code': fake.postcode(),
+         'country': fake.country()[:100],
+         'phone_number': fake.phone_number()[:20],
+         'label': rng.choice(ADDRESS_LABELS)}
+        for index in range(start, start + count)]}
+
+
+def generate_products(start, count, rng, fake):
+    first = _plan['first_ids']['product']
+    first_user = _plan['first_ids']['user']
+    return {'product': [
+        {'id': first + index,
+         'name': fake.word().capitalize() + " " + fake.word().capitalize(),
+         'description': fake.sentence(nb_words=10),
+         'price': round(rng.uniform(1, 999), 2),
+         'condition': rng.choice(_plan['conditions']),
+         'rating': round(rng.uniform(0, 5), 1),
+         'image_filename': rng.choice(_plan['images']),
+         'user_id': first_user + rng.randrange(_plan['users'])}
+        for index in range(start, start + count)]}
+
+
+def generate_carts(start, count, rng, fake):
+    first_user = _plan['first_ids']['user']
+    first_product = _plan['first_ids']['product']
+    rows = []
+    for index in range(start, start + count):
+        # A product is in a user's cart at most once
+        for product in rng.sample(range(_plan['products']),
+                                  _plan['cart_items']):
+            rows.append({'user_id': first_user + index,
+                         'product_id': first_product + product,
+                         'quantity': rng.randint(1, 3)})
+    return {'cart': rows}
+
+
+def generate_orders(start, count, rng, fake):
+    first = _plan['first_ids']['purchase_event']
+    first_user = _plan['first_ids']['user']
+    first_address = _plan['first_ids']['address']
+    first_product = _plan['first_ids']['product']
+    per_user = _plan['addresses_per_user']
+    seconds = _plan['days'] * 24 * 60 * 60
+    events = []
+    purchases = []
+    for index in range(start, start + count):
+        user = rng.randrange(_plan['users'])
+        events.append({
+            'id': first + index, 'user_id': first_user + user,
+            'address_id': (first_address + user * per_user
+                           + rng.randrange(per_user)),
+            'purchase_date': _plan['end_date'] - timedelta(
+                seconds=rng.randrange(seconds))})
+        items = rng.randint(1, _plan['max_order_items'])
+        for product in rng.sample(range(_plan['products']), items):
+            purchases.append({'purchase_event_id': first + index,
+                              'product_id': first_product + product,
+                              'quantity': rng.randint(1, 3)})
+    return {'purchase_event': events, 'purchase': purchases}
+
+
+GENERATORS = {
+    'user': generate_users,
+    'address': generate_addresses,
+    'product': generate_products,
+    'cart': generate_carts,
+    'purchase_event': generate_orders,
+}
+
+
+def generate_chunk(chunk):
+    """Return the rows of one chunk as a dict of table name to rows."""
+    table, start, count = chunk
+    rng, fake = chunk_generators(table, start)
+    return GENERATORS[table](start, count, rng, fake)
+
+
+def generate(plan, batch_size, workers):
+    """Yield the rows of every chunk, in insert order.
+
+    With more than one worker the chunks are generated in a process pool
+    while the caller inserts the ones already finished.
+    """
+    chunks = plan_chunks(plan, batch_size)
+    if workers <= 1:
+        use_plan(plan)
+        yield from map(generate_chunk, chunks)
+        return
+    with Pool(workers, initializer=use_plan, initargs=(plan,)) as pool:
+        yield from pool.imap(generate_chunk, chunks)